@@ -34,7 +34,6 @@ def login():
                     st.session_state['student_number'] = username.lower()
                     st.session_state['is_authenticated'] = True
                     st.experimental_rerun()
-                    st.cache_data.clear()
                 else:
                     st.error('Incorrect username')
     logout_button()
@@ -50,7 +49,6 @@ def logout_button():
             st.session_state['is_authenticated'] = False
             st.session_state['student_number'] = None
             st.experimental_rerun()
-            st.cache_data.clear()
             st.success('Logged out successfully.')
 
 
@@ -1,9 +1,38 @@
 import firebase_admin
 from firebase_admin import firestore
+from google.api_core import exceptions
 from backend import credential, gcp_handler
+import file_io
+from datetime import datetime, timedelta, timezone
+import threading
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import streamlit as st
 
+# number of documents fetched per page when streaming the whole inventory
+ITEMS_PAGE_SIZE = 1000
+# delta syncs re-read this window before the high-water mark to catch writes committed out of order
+SYNC_OVERLAP = timedelta(seconds=5)
+# how long the snapshot is trusted before get_data checks Firestore for writes made by other app instances
+SYNC_INTERVAL = timedelta(minutes=1)
+# maximum number of writes in a single Firestore batch
+BATCH_LIMIT = 500
+# on-disk copy of the inventory snapshot, served on cold start while Firestore is revalidated in the background
+INVENTORY_CACHE_PATH = 'cache/inventory.arrow'
+INVENTORY_CACHE_FORMAT = '2'
+# document stamped by maintenance scripts that rewrite items without moving their `time`, which delta syncs miss.
+# Every snapshot older than the stamp is loaded again in full on its next sync
+SYNC_RESET_DOCUMENT = ('Sync', 'inventory')
+# column order of the inventory table, shared by pd_table and the benchmarks
+TABLE_COLUMNS = ['delete', 'student_number', 'spec_id', 'name', 'uid', 'material', 'amount', 'unit', 'notes',
+                 'source_name', 'source_notes', 'source_year', 'source_latitude', 'source_longitude',
+                 'source_country', 'source_state', 'source_city',
+                 'origin_name', 'origin_notes', 'origin_year', 'origin_latitude', 'origin_longitude',
+                 'origin_country', 'origin_state', 'origin_city',
+                 'images', '3d_model', 'time', 'model_scale']
+
 
 def get_init_firestore_app(name='default'):
     try:
@@ -32,10 +61,17 @@ def get_user_ref(student_number: str):
     return user_ref
 
 
-def set_data(data: dict, uid: str):
-    """Sets the data in the database. This function should be called when the user submits the data form."""
-    student_number = st.session_state['student_number']
-    user_ref = get_user_ref(student_number)
+@firestore.transactional
+def _set_item(transaction, item_ref, data):
+    """Sets the item and returns the data of the version it overwrote, or None."""
+    previous = item_ref.get(transaction=transaction)
+    transaction.set(item_ref, data)
+    return previous.to_dict() if previous.exists else None
+
+
+def set_item(db, student_number: str, uid: str, data: dict, write_id=None):
+    """Sets the item of the user without reading the session, so the job worker can call it."""
+    user_ref = db.collection('Users').document(student_number)
 
     # Check if user is admin
     is_admin = False
@@ -45,42 +81,221 @@ def set_data(data: dict, uid: str):
     access = "admin" if is_admin else "user"
     user_ref.set({'access': access})
 
-    # Store data
+    # Store data, stamped with the server time so delta syncs can pick it up
+    data['time'] = firestore.SERVER_TIMESTAMP
+    if write_id is not None:
+        data['write_id'] = write_id
     item_ref = user_ref.collection('Items').document(uid)
-    item_ref.set(data)
+    previous = _set_item(db.transaction(), item_ref, data)
 
+    # once the write is committed the shared assets of the overwritten version lose a reference, the new ones were
+    # acquired on upload. A rerun of the write overwrites its own version, whose references were only acquired once
+    if previous is not None and not (write_id is not None and previous.get('write_id') == write_id):
+        release_assets(db, gcp_handler.get_bucket(), previous.get('assets', []))
+    return data
 
-def update_data(data: dict, uid: str, student_number: str):
-    """Updates the data in the database. This function should be called when the user modified the database table."""
-    user_ref = get_user_ref(student_number)
 
-    # update data
-    item_ref = user_ref.collection('Items').document(uid)
+def set_data(data: dict, uid: str):
+    """Sets the data in the database. This function should be called when the user submits the data form."""
+    student_number = st.session_state['student_number']
+    data = set_item(st.session_state['db'], student_number, uid, data)
+    patch_snapshot(upserts=[{**data, 'uid': uid, 'student_number': student_number}])
+
+
+def update_item(db, student_number: str, uid: str, data: dict):
+    """Updates the item of the user and returns the updated fields, without reading the session."""
+    # update data, stamped with the server time so delta syncs can pick it up
+    data['time'] = firestore.SERVER_TIMESTAMP
+    item_ref = db.collection('Users').document(student_number).collection('Items').document(uid)
     item_ref.update(data)
+    return data
+
+
+def update_data(data: dict, uid: str, student_number: str):
+    """Updates the data in the database. This function should be called when the user modified the database table."""
+    data = update_item(st.session_state['db'], student_number, uid, data)
+    patch_snapshot(updates=[{'uid': uid, 'modified_fields': data}])
 
 
 def delete_data(uid: str, student_number: str):
     """Deletes the data in the database. This function should be called when the user modified the database table."""
     user_ref = get_user_ref(student_number)
-
-
     item_ref = user_ref.collection('Items').document(uid)
+    item_data = item_ref.get().to_dict() or {}
 
-    # get 3d model and images path
-    item_data = item_ref.get().to_dict()
-    models_path = item_data['3d_model']
-    images_path = item_data['images']
+    # delete everything under the item's folder from the bucket, the item is only deleted once its blobs are gone
+    bucket = gcp_handler.get_bucket()
+    errors = gcp_handler.delete_item_blobs(bucket, st.session_state['db_root'], [uid])
+    if errors:
+        st.error(f'failed to delete files of {uid} from bucket. **{errors[uid]}**')
+        st.stop()
 
-    # get filenames
-    models_filename = [model_path.split('/')[-1] for model_path in models_path]
-    images_filename = [image_path.split('/')[-1] for image_path in images_path]
-
-    # delete from bucket
-    gcp_handler.delete_from_bucket(st.session_state['db_root'], models_filename, uid)
-    gcp_handler.delete_from_bucket(st.session_state['db_root'], images_filename, uid)
-
-    # delete data
-    item_ref.delete()
+    # delete data and leave a tombstone so delta syncs drop the item from their snapshot
+    db = st.session_state['db']
+    batch = db.batch()
+    batch.delete(item_ref)
+    batch.set(db.collection('Tombstones').document(uid),
+              {'student_number': student_number, 'time': firestore.SERVER_TIMESTAMP})
+    batch.commit()
+    # only once the item is gone, a failed delete would otherwise release its shared assets again on the next try
+    release_assets(db, bucket, item_data.get('assets', []))
+    patch_snapshot(deletes=[uid])
+
+
+def get_assets(db, keys):
+    """Returns the shared content-addressed assets already stored among the keys, as key -> asset document."""
+    asset_refs = [db.collection('Assets').document(key) for key in set(keys)]
+    if not asset_refs:
+        return {}
+    return {asset_doc.id: asset_doc.to_dict() for asset_doc in db.get_all(asset_refs) if asset_doc.exists}
+
+
+@firestore.transactional
+def _acquire_assets(transaction, db, refs):
+    """Adds the asset references in a transaction and returns the keys of the stored assets that are gone."""
+    stored = [db.collection('Assets').document(key) for key, (count, fields) in refs.items() if not fields]
+    missing = [asset_doc.id for asset_doc in transaction.get_all(stored) if not asset_doc.exists] if stored else []
+    if missing:
+        return missing
+    for key, (count, fields) in refs.items():
+        transaction.set(db.collection('Assets').document(key),
+                        {**fields, 'refs': firestore.Increment(count), 'time': firestore.SERVER_TIMESTAMP}, merge=True)
+    return []
+
+
+def acquire_assets(db, assets):
+    """Adds a reference to each shared asset and returns the keys of the assets that must be uploaded again."""
+    refs = {}
+    for key, fields in assets:
+        # an asset used twice by the item gets two references
+        count, known_fields = refs.get(key, (0, {}))
+        refs[key] = (count + 1, {**known_fields, **fields})
+    return _acquire_assets(db.transaction(), db, refs)
+
+
+@firestore.transactional
+def _release_asset(transaction, asset_ref):
+    """Drops a reference to the asset. Returns the blob path of the asset if it was its last reference."""
+    asset_doc = asset_ref.get(transaction=transaction)
+    if not asset_doc.exists:
+        return None
+    asset = asset_doc.to_dict()
+    if asset.get('refs', 0) <= 1:
+        transaction.delete(asset_ref)
+        return asset['path']
+    transaction.update(asset_ref, {'refs': firestore.Increment(-1)})
+    return None
+
+
+def release_assets(db, bucket, keys):
+    """Drops a reference to each shared asset, deleting the assets no item refers to anymore."""
+    for key in keys:
+        path = _release_asset(db.transaction(), db.collection('Assets').document(key))
+        if not path:
+            continue
+        paths = [path]
+        # images take their thumbnails with them
+        if gcp_handler.get_blob_category(bucket.blob(path)) == 'image':
+            paths += [gcp_handler.get_thumbnail_name(path, size) for size in file_io.THUMBNAIL_SIZES]
+        for path in paths:
+            try:
+                bucket.blob(path).delete()
+            except exceptions.NotFound:
+                pass
+
+
+def _chunks(rows, size):
+    """Splits the rows into lists of at most `size` rows."""
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+def _commit_rows(db, rows, add_writes):
+    """Commits the writes of the rows in a single batch."""
+    batch = db.batch()
+    for row in rows:
+        add_writes(batch, row)
+    batch.commit()
+
+
+def _commit_in_batches(db, rows, writes_per_row, add_writes):
+    """Commits the rows in batches, retrying the rows of a failed batch one by one, and returns a report."""
+    report = []
+    for chunk in _chunks(rows, BATCH_LIMIT // writes_per_row):
+        try:
+            _commit_rows(db, chunk, add_writes)
+            report.extend({**row, 'success': True, 'error': None} for row in chunk)
+            continue
+        except Exception as e:
+            if len(chunk) == 1:
+                report.append({**chunk[0], 'success': False, 'error': str(e)})
+                continue
+        for row in chunk:
+            try:
+                _commit_rows(db, [row], add_writes)
+                report.append({**row, 'success': True, 'error': None})
+            except Exception as e:
+                report.append({**row, 'success': False, 'error': str(e)})
+    return report
+
+
+def commit_changes(updates: list, deletes: list):
+    """Commits the updates and deletes of the database table in batches and returns a report per row."""
+    db = st.session_state['db']
+    report = []
+
+    def item_ref(row):
+        return get_user_ref(row['student_number']).collection('Items').document(row['uid'])
+
+    # updates
+    update_rows = [{'uid': row['uid'], 'student_number': row['student_number'], 'action': 'update'}
+                   for row in updates]
+    fields = {row['uid']: {**row['modified_fields'], 'time': firestore.SERVER_TIMESTAMP} for row in updates}
+
+    def add_update(batch, row):
+        batch.update(item_ref(row), fields[row['uid']])
+
+    report.extend(_commit_in_batches(db, update_rows, 1, add_update))
+
+    # deletes: read every item in one request, then delete the blobs of all items in batched requests
+    delete_rows = [{'uid': row['uid'], 'student_number': row['student_number'], 'action': 'delete'}
+                   for row in deletes]
+    item_docs = {doc.id: doc for doc in db.get_all([item_ref(row) for row in delete_rows])} if delete_rows else {}
+    existing = []
+    for row in delete_rows:
+        item_doc = item_docs.get(row['uid'])
+        if item_doc is None or not item_doc.exists:
+            report.append({**row, 'success': False, 'error': 'item does not exist'})
+        else:
+            existing.append(row)
+
+    bucket = gcp_handler.get_bucket() if existing else None
+    errors = gcp_handler.delete_item_blobs(bucket, st.session_state['db_root'], [row['uid'] for row in existing])
+    assets_deleted = []
+    for row in existing:
+        if row['uid'] in errors:
+            report.append({**row, 'success': False, 'error': f"failed to delete assets: {errors[row['uid']]}"})
+            continue
+        assets_deleted.append(row)
+
+    def add_delete(batch, row):
+        # leave a tombstone so delta syncs drop the item from their snapshot
+        batch.delete(item_ref(row))
+        batch.set(db.collection('Tombstones').document(row['uid']),
+                  {'student_number': row['student_number'], 'time': firestore.SERVER_TIMESTAMP})
+
+    deleted = _commit_in_batches(db, assets_deleted, 2, add_delete)
+    report.extend(deleted)
+    # only the deleted items release their shared assets, a failed row keeps its references for the next try
+    for row in deleted:
+        if row['success']:
+            release_assets(db, bucket, item_docs[row['uid']].to_dict().get('assets', []))
+
+    # patch the committed rows into the snapshot instead of reloading the inventory
+    committed = [row for row in report if row['success']]
+    patch_snapshot(updates=[{'uid': row['uid'], 'modified_fields': fields[row['uid']]}
+                            for row in committed if row['action'] == 'update'],
+                   deletes=[row['uid'] for row in committed if row['action'] == 'delete'])
+    return report
 
 
 def explode_list(df, col_name):
@@ -102,30 +317,85 @@ def explode_list(df, col_name):
     return df
 
 
-@st.cache_data
-def get_data(columns_order):
-    """Gets the data from the database. This function should be called when user wants to retrieve data to dataframe."""
-    db = st.session_state['db']
-    users_ref = db.collection('Users')
-    users_docs = users_ref.stream()
-    print("Fetching data from firestore...")
-
-    data = []
-    for user_doc in users_docs:
-        user_id = user_doc.id
-        items_ref = users_ref.document(user_id).collection('Items')
-        items_docs = items_ref.stream()
-
-        for item_doc in items_docs:
-            item_data = item_doc.to_dict()
-            item_id = item_doc.id
-            item_data['uid'] = item_id
-            item_data['student_number'] = user_id
-
-            data.append(item_data)
-    df = pd.DataFrame(data)
+def iter_query(query, page_size=ITEMS_PAGE_SIZE):
+    """Yields every document of an ordered query, paging through the results with cursors."""
+    query = query.limit(page_size)
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        docs = list(page.stream())
+        yield from docs
+        if len(docs) < page_size:
+            break
+        last_doc = docs[-1]
+
+
+def is_inventory_item(item_doc):
+    """Only items nested under Users/{student_number}/Items belong to the inventory."""
+    user_ref = item_doc.reference.parent.parent
+    return user_ref is not None and user_ref.parent.id == 'Users'
+
+
+def iter_items(db, page_size=ITEMS_PAGE_SIZE):
+    """Yields every item document with a single collection group query, paging through the results with cursors."""
+    query = db.collection_group('Items').order_by('__name__')
+    for item_doc in iter_query(query, page_size):
+        if is_inventory_item(item_doc):
+            yield item_doc
+
+
+def iter_changed_items(db, since, page_size=ITEMS_PAGE_SIZE):
+    """Yields the item documents written at or after `since`."""
+    query = (db.collection_group('Items')
+             .where(filter=firestore.FieldFilter('time', '>=', since))
+             .order_by('time'))
+    for item_doc in iter_query(query, page_size):
+        if is_inventory_item(item_doc):
+            yield item_doc
+
+
+def get_page(db, sort_key='__name__', page_size=100, cursor=None):
+    """Fetches the page of items ordered by `sort_key` after the `cursor` document, with the next cursor."""
+    query = db.collection_group('Items')
+    if sort_key != '__name__':
+        query = query.order_by(sort_key)
+    # the document path breaks ties, so pages never overlap
+    query = query.order_by('__name__').limit(page_size + 1)
+    if cursor is not None:
+        query = query.start_after(cursor)
+
+    docs = list(query.stream())
+    next_cursor = docs[page_size - 1] if len(docs) > page_size else None
+    records = [item_to_record(item_doc) for item_doc in docs[:page_size] if is_inventory_item(item_doc)]
+    return records, next_cursor
+
+
+def iter_tombstones(db, since, page_size=ITEMS_PAGE_SIZE):
+    """Yields the tombstones of items deleted at or after `since`."""
+    query = db.collection('Tombstones').where(filter=firestore.FieldFilter('time', '>=', since)).order_by('time')
+    yield from iter_query(query, page_size)
+
+
+def item_to_record(item_doc):
+    """Converts an item document to a flat record, taking the owner from the document's parent path."""
+    item_data = item_doc.to_dict()
+    item_data['uid'] = item_doc.id
+    item_data['student_number'] = item_doc.reference.parent.parent.id
+    return item_data
+
+
+def records_to_dataframe(data, columns_order):
+    """Builds the inventory DataFrame from item records or an Arrow table of them."""
+    if isinstance(data, pa.Table):
+        data = data.select([column for column in columns_order if column in data.column_names])
+        df = data.to_pandas()
+        # lists come out as arrays, only their columns are turned into Python lists to be exploded
+        for column in data.column_names:
+            if pa.types.is_list(data.schema.field(column).type):
+                df[column] = data[column].to_pylist()
+    else:
+        df = pd.DataFrame(data)
     # reorder columns
-    exist_columns = []
     # check if column exists
     exist_columns = []
     for column in columns_order:
@@ -137,10 +407,356 @@ def get_data(columns_order):
     print("Exploding columns...")
     df = explode_list(df, 'images')
     df = explode_list(df, '3d_model')
+    for column in exist_columns:
+        # items uploaded before thumbnails were made have none
+        if column.startswith('thumbnails_'):
+            df[column] = df[column].apply(lambda value: value if isinstance(value, list) else [])
+            df = explode_list(df, column)
 
     return df
 
 
+# process-wide inventory snapshot, shared by every session and by the background revalidation thread
+_snapshot = {
+    'items': {},  # uid -> item record
+    'table': None,  # memory-mapped disk cache the items were restored from, until they are first needed as records
+    'high_water': None,  # latest item/tombstone time seen
+    'generation': 0,  # bumped whenever the items change
+    'synced_at': None,  # when the snapshot was last checked against Firestore
+    'reset': None,  # the full reload request the snapshot was loaded after
+    'lock': threading.Lock()
+}
+# serializes the disk cache writes, so a slower refresh does not overwrite the copy of a later one
+_inventory_cache = {
+    'generation': None,  # generation of the snapshot last written to disk
+    'lock': threading.Lock()
+}
+
+
+def get_snapshot():
+    """Returns the process-wide inventory snapshot that delta syncs are merged into."""
+    return _snapshot
+
+
+def reset_snapshot():
+    """Forgets the inventory snapshot, so the next sync loads every item again."""
+    with _snapshot['lock']:
+        _snapshot['items'].clear()
+        _snapshot['table'] = None
+        _snapshot['high_water'] = None
+        _snapshot['synced_at'] = None
+        _snapshot['reset'] = None
+        _snapshot['generation'] += 1
+
+
+def _present_fields(record):
+    """Returns the record without its empty fields, which the columns of a table give every record."""
+    return {key: value for key, value in record.items() if value is not None}
+
+
+def _table_records(table):
+    """Returns the rows of an Arrow table of item records as records, without the fields the item does not have."""
+    return [_present_fields(row) for row in table.to_pylist()]
+
+
+def _get_items(snapshot):
+    """Returns the snapshot's item records as uid -> record. Call with the lock held."""
+    if snapshot['table'] is not None:
+        snapshot['items'].clear()
+        snapshot['items'].update((record['uid'], record) for record in _table_records(snapshot['table']))
+        snapshot['table'] = None
+    return snapshot['items']
+
+
+def _get_record(snapshot, uid):
+    """Returns the item record of the uid without its empty fields, or None. Call with the lock held."""
+    table = snapshot['table']
+    if table is None:
+        record = snapshot['items'].get(uid)
+        return None if record is None else _present_fields(record)
+    position = pc.index(table['uid'], uid).as_py()
+    return _table_records(table.slice(position, 1))[0] if position >= 0 else None
+
+
+def get_records(uids):
+    """Returns the item records of the uids in the snapshot as uid -> record."""
+    snapshot = get_snapshot()
+    with snapshot['lock']:
+        table = snapshot['table']
+        if table is None:
+            items = snapshot['items']
+            return {uid: items[uid] for uid in uids if uid in items}
+    rows = table.filter(pc.is_in(table['uid'], value_set=pa.array(list(uids), pa.string())))
+    return {record['uid']: record for record in _table_records(rows)}
+
+
+def _local_value(value):
+    """Replaces the server timestamp placeholder of a write with the local time, until a sync reads the real one."""
+    return datetime.now(timezone.utc) if value is firestore.SERVER_TIMESTAMP else value
+
+
+def patch_snapshot(upserts=(), updates=(), deletes=()):
+    """Applies writes made by this app to the snapshot, leaving the high-water mark alone."""
+    snapshot = get_snapshot()
+    with snapshot['lock']:
+        if snapshot['high_water'] is None:
+            # nothing loaded yet, the first sync will read the writes
+            return
+        items = _get_items(snapshot)
+        for record in upserts:
+            items[record['uid']] = {key: _local_value(value) for key, value in record.items()}
+        for update in updates:
+            if update['uid'] in items:
+                # replaced rather than changed in place, records handed out for an earlier version keep their values
+                modified_fields = {key: _local_value(value) for key, value in update['modified_fields'].items()}
+                items[update['uid']] = {**items[update['uid']], **modified_fields}
+        for uid in deletes:
+            items.pop(uid, None)
+        snapshot['generation'] += 1
+
+
+def _latest_time(current, value):
+    """Returns the later of the high-water mark and the value, ignoring values that are not timestamps."""
+    if not isinstance(value, datetime):
+        return current
+    return value if current is None or value > current else current
+
+
+def get_sync_reset(db):
+    """Returns when a full reload of every snapshot was last requested, or None."""
+    reset_doc = db.collection(SYNC_RESET_DOCUMENT[0]).document(SYNC_RESET_DOCUMENT[1]).get()
+    return (reset_doc.to_dict() or {}).get('reset')
+
+
+def request_full_sync(db):
+    """Makes every app instance load the whole inventory again on its next sync."""
+    db.collection(SYNC_RESET_DOCUMENT[0]).document(SYNC_RESET_DOCUMENT[1]).set({'reset': firestore.SERVER_TIMESTAMP})
+
+
+def _fetch_changes(db, high_water, reset_seen):
+    """Runs the queries of a sync without the snapshot lock and returns what they fetched."""
+    reset = get_sync_reset(db)
+    if high_water is not None and reset is not None and (reset_seen is None or reset > reset_seen):
+        print("Full reload of the inventory requested...")
+        high_water = None
+    if high_water is None:
+        print("Fetching data from firestore...")
+        return True, [item_to_record(item_doc) for item_doc in iter_items(db)], [], reset
+    print("Syncing data from firestore...")
+    since = high_water - SYNC_OVERLAP
+    return (False, [item_to_record(item_doc) for item_doc in iter_changed_items(db, since)],
+            list(iter_tombstones(db, since)), reset)
+
+
+def sync_items(db):
+    """Brings the inventory snapshot up to date, loading every item on the first call and only changes after."""
+    snapshot = get_snapshot()
+    with snapshot['lock']:
+        high_water = snapshot['high_water']
+        reset_seen = snapshot['reset']
+    # items still holding a string time cannot move the mark, so a full load falls back to its start
+    started = datetime.now(timezone.utc)
+    full, records, tombstones, reset = _fetch_changes(db, high_water, reset_seen)
+
+    with snapshot['lock']:
+        changed = False
+        if full:
+            snapshot['items'] = {record['uid']: record for record in records}
+            snapshot['table'] = None
+            high_water = None
+            for record in records:
+                high_water = _latest_time(high_water, record.get('time'))
+            high_water = high_water or started
+            snapshot['reset'] = reset
+            changed = True
+        elif snapshot['high_water'] is None:
+            # the snapshot was reset while the changes were fetched, the next sync loads it in full
+            return snapshot
+        else:
+            for record in records:
+                # the overlap window re-reads items that are already up to date
+                if _get_record(snapshot, record['uid']) != _present_fields(record):
+                    _get_items(snapshot)[record['uid']] = record
+                    changed = True
+                high_water = _latest_time(high_water, record.get('time'))
+            for tombstone in tombstones:
+                deleted_at = tombstone.get('time')
+                record = _get_record(snapshot, tombstone.id)
+                # a tombstone older than the item means the uid was written again after the delete
+                if record is not None and not (isinstance(record.get('time'), datetime)
+                                               and record['time'] > deleted_at):
+                    del _get_items(snapshot)[tombstone.id]
+                    changed = True
+                high_water = _latest_time(high_water, deleted_at)
+
+        # another sync may have merged newer changes meanwhile
+        snapshot['high_water'] = _latest_time(snapshot['high_water'], high_water) if not full else high_water
+        snapshot['synced_at'] = datetime.now(timezone.utc)
+        if changed:
+            snapshot['generation'] += 1
+    return snapshot
+
+
+def get_inventory_version():
+    """Returns the generation of the inventory snapshot, which changes whenever its items change."""
+    return get_snapshot()['generation']
+
+
+def save_inventory_cache(snapshot, path=INVENTORY_CACHE_PATH):
+    """Writes the snapshot's item records to disk as an Arrow IPC file stamped with its high-water mark."""
+    records = _sort_records(_get_items(snapshot).values())
+    columns = {}
+    for record in records:
+        for key in record:
+            columns.setdefault(key, None)
+    try:
+        table = pa.Table.from_pydict({key: [record.get(key) for record in records] for key in columns})
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # e.g. `time` still mixing strings and timestamps before the migration
+        print(f"Skipping inventory disk cache: {e}")
+        return
+    table = table.replace_schema_metadata({
+        'format': INVENTORY_CACHE_FORMAT,
+        'high_water': snapshot['high_water'].isoformat(),
+        'reset': snapshot['reset'].isoformat() if snapshot['reset'] else ''
+    })
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with pa.OSFile(temp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+
+def load_inventory_cache(path=INVENTORY_CACHE_PATH):
+    """Memory-maps the on-disk inventory cache and returns its table and sync state, or None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        metadata = table.schema.metadata or {}
+        if metadata.get(b'format') != INVENTORY_CACHE_FORMAT.encode():
+            return None
+        high_water = datetime.fromisoformat(metadata[b'high_water'].decode())
+        reset = metadata.get(b'reset', b'').decode()
+        reset = datetime.fromisoformat(reset) if reset else None
+    except (OSError, pa.ArrowInvalid, KeyError, ValueError) as e:
+        print(f"Ignoring inventory disk cache: {e}")
+        return None
+    return table, high_water, reset
+
+
+def restore_snapshot():
+    """Fills an empty snapshot from the disk cache. Returns True if it was restored."""
+    snapshot = get_snapshot()
+    with snapshot['lock']:
+        if snapshot['high_water'] is not None:
+            return False
+        cached = load_inventory_cache()
+        if cached is None:
+            return False
+        table, high_water, reset = cached
+        print("Loaded inventory from disk cache...")
+        # the items are only read from the table once a write or a sync changes them
+        snapshot['items'].clear()
+        snapshot['table'] = table
+        snapshot['high_water'] = high_water
+        snapshot['reset'] = reset
+        # counts as fresh, the revalidation started by the caller is checking Firestore
+        snapshot['synced_at'] = datetime.now(timezone.utc)
+        snapshot['generation'] += 1
+    return True
+
+
+def refresh_snapshot(db):
+    """Syncs the snapshot with Firestore and rewrites the disk cache if anything changed. Returns True on change."""
+    snapshot = get_snapshot()
+    generation = snapshot['generation']
+    sync_items(db)
+    if snapshot['generation'] == generation:
+        return False
+    # written from a copy, so the lock is not held while the file is
+    with snapshot['lock']:
+        saved = {'items': dict(_get_items(snapshot)), 'table': None, 'high_water': snapshot['high_water'],
+                 'reset': snapshot['reset'], 'generation': snapshot['generation']}
+    with _inventory_cache['lock']:
+        if _inventory_cache['generation'] is None or saved['generation'] > _inventory_cache['generation']:
+            save_inventory_cache(saved)
+            _inventory_cache['generation'] = saved['generation']
+    return True
+
+
+def revalidate_snapshot(db):
+    """Syncs a snapshot restored from disk in the background."""
+    try:
+        refresh_snapshot(db)
+    except Exception as e:
+        print(f"Failed to revalidate inventory: {e}")
+
+
+def _sort_records(records):
+    """Sorts item records in the order of a full load: by student number, then by uid."""
+    return sorted(records, key=lambda record: (record['student_number'], record['uid']))
+
+
+def get_sorted_records():
+    """Returns the item records of the snapshot in the order of a full load: by student number, then by uid."""
+    snapshot = get_snapshot()
+    with snapshot['lock']:
+        return _sort_records(_get_items(snapshot).values())
+
+
+def get_inventory_data(version=None):
+    """Returns the inventory for building frames, or None if the snapshot moved past `version`."""
+    snapshot = get_snapshot()
+    with snapshot['lock']:
+        if version is not None and snapshot['generation'] != version:
+            return None
+        if snapshot['table'] is not None:
+            return snapshot['table']
+        # writes replace the records instead of changing them, so the list stays at this version
+        return _sort_records(_get_items(snapshot).values())
+
+
+def records_to_arrow(records, columns_order):
+    """Builds an Arrow table of the item records, or selects from an Arrow table of them."""
+    if isinstance(records, pa.Table):
+        return records.select([column for column in columns_order if column in records.column_names])
+    columns = {}
+    for column in columns_order:
+        values = [record.get(column) for record in records]
+        if all(value is None for value in values):
+            continue
+        try:
+            columns[column] = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns[column] = pa.array([None if value is None else str(value) for value in values], pa.string())
+    return pa.table(columns)
+
+
+@st.cache_data(max_entries=4)
+def build_data(columns_order, version):
+    """Builds the inventory DataFrame from the snapshot, cached per inventory version."""
+    df = records_to_dataframe(get_inventory_data(), columns_order)
+    # tag the frame with the inventory version it was built from, for caches derived from it
+    df.attrs['version'] = version
+    return df
+
+
+def get_data(columns_order):
+    """Gets the data from the database. This function should be called when user wants to retrieve data to dataframe."""
+    db = st.session_state['db']
+    if restore_snapshot():
+        # serve the disk copy at once, Firestore is checked for changes in the background
+        threading.Thread(target=revalidate_snapshot, args=(db,), daemon=True).start()
+    else:
+        synced_at = get_snapshot()['synced_at']
+        if synced_at is None or datetime.now(timezone.utc) - synced_at > SYNC_INTERVAL:
+            refresh_snapshot(db)
+    return build_data(columns_order, get_inventory_version())
+
+
 def close_app_if_exists(name='default'):
     """Closes the Firebase app if it exists. This function should be called at the beginning of the script."""
     try:
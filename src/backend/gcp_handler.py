@@ -1,126 +1,552 @@
 from backend import credential
-import urllib.parse
 from google.cloud import storage
+from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+import requests
 import streamlit as st
 import os
 import json
+import time
+import base64
+import hashlib
+import random
+import uuid
+import threading
 import fnmatch
+import queue
+import zipfile
+import urllib.parse
+import zstandard
+from concurrent.futures import ThreadPoolExecutor
 import file_io
 import utils
 import traceback
 import io
 
+# file extensions of each asset category
+CATEGORY_EXTENSIONS = {
+    'image': ['.jpg', '.jpeg', '.png', '.webp'],
+    '3d_model': ['.obj', '.3dm', '.gz', '.xz', '.zst']
+}
+# folder of the trained zstd dictionaries, stored as {root}/dictionaries/{dictionary id}.zdict
+DICTIONARY_DIR = 'dictionaries'
+# thumbnails are stored next to their image as {folder}/thumbnails/{name}-{size}.webp
+THUMBNAIL_DIR = 'thumbnails'
+# folder of the content-addressed layout, where each asset is stored once as {root}/cas/{md5}{extension}
+CAS_DIR = 'cas'
+# folders under the root that are not item folders, so no item may take their name as its uid
+RESERVED_UIDS = [CAS_DIR, DICTIONARY_DIR]
+# size of the parts a streamed upload is sent in, a multiple of 256KB as resumable uploads require
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# attempts per part after the first, waiting UPLOAD_BACKOFF seconds doubled on each attempt
+UPLOAD_RETRIES = 5
+UPLOAD_BACKOFF = 1.0
+UPLOAD_TIMEOUT = (10, 300)
+# responses worth retrying a part on
+RETRYABLE_STATUS = [408, 429, 500, 502, 503, 504]
+# resumable session URIs of unfinished uploads, so a retried submit continues where the last one stopped
+UPLOAD_SESSIONS_PATH = 'cache/upload_sessions.json'
+# maximum number of calls in a single batched request
+DELETE_BATCH_SIZE = 100
+# number of item folders listed at once
+LIST_WORKERS = 8
+# downloaded assets are kept here, named by their md5, and the least recently used go once the limit is passed
+ASSET_CACHE_DIR = 'cache/assets'
+ASSET_CACHE_LIMIT = 2 * 1024 ** 3
+# blobs larger than this are downloaded as RANGE_SIZE byte ranges, RANGE_WORKERS at once
+RANGE_THRESHOLD = 32 * 1024 * 1024
+RANGE_SIZE = 8 * 1024 * 1024
+RANGE_WORKERS = 8
+# connections kept open to the storage API, shared by every session and worker thread
+HTTP_POOL_SIZE = 32
+# ZIP bundles are written here, the oldest go once there are more than BUNDLE_CACHE_ENTRIES
+BUNDLE_DIR = 'cache/bundles'
+BUNDLE_CACHE_ENTRIES = 4
+# bundled blobs are read in chunks, BUNDLE_WORKERS at once with at most BUNDLE_QUEUE_DEPTH chunks waiting for the
+# ZIP writer per blob, so memory stays under BUNDLE_WORKERS * BUNDLE_QUEUE_DEPTH * BUNDLE_CHUNK_SIZE
+BUNDLE_CHUNK_SIZE = 2 * 1024 * 1024
+BUNDLE_WORKERS = 8
+BUNDLE_QUEUE_DEPTH = 2
+# the download button holds the bundle in memory while it is shown, larger bundles are refused
+BUNDLE_MAX_SIZE = 512 * 1024 * 1024
+
+# process-wide storage client and bucket handles, created once instead of on every rerun
+_storage = {
+    'client': None,
+    'buckets': {},  # bucket name -> bucket handle
+    'dictionaries': {},  # zstd dictionary id -> dictionary
+    'lock': threading.Lock()
+}
+_upload_sessions_lock = threading.Lock()
+
+
+def create_storage_client():
+    """Creates a storage client from the in-memory credentials, over a pooled HTTP session."""
+    creds = service_account.Credentials.from_service_account_info(credential.google_creds(),
+                                                                  scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(creds)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    return storage.Client(project=creds.project_id, credentials=creds, _http=session)
+
+
+def init(storage_client=None):
+    """Sets up the process-wide storage client unless it exists, using the given client if any."""
+    with _storage['lock']:
+        if storage_client is not None and storage_client is not _storage['client']:
+            _storage['client'] = storage_client
+            _storage['buckets'].clear()
+        elif _storage['client'] is None:
+            _storage['client'] = create_storage_client()
+    st.session_state['storage_client'] = _storage['client']
+
+
+def get_storage_client():
+    """Returns the process-wide storage client."""
+    if _storage['client'] is None:
+        init()
+    return _storage['client']
+
+
+def get_bucket(bucket_name=None):
+    """Returns the handle of the bucket, the app's bucket by default, created once per process."""
+    if bucket_name is None:
+        bucket_name = st.secrets['gcp']['bucket_name']
+    buckets = _storage['buckets']
+    if bucket_name not in buckets:
+        bucket = get_storage_client().bucket(bucket_name)
+        with _storage['lock']:
+            buckets.setdefault(bucket_name, bucket)
+    return buckets[bucket_name]
+
+
+def is_content_addressed():
+    """Whether assets are stored once per content hash and shared between items."""
+    return st.secrets['gcp'].get('content_addressed', False)
+
+
+def get_zstd_dictionary(root_dir, dict_id):
+    """Returns the trained zstd dictionary with the id, downloaded once per process."""
+    dictionaries = _storage['dictionaries']
+    if dict_id not in dictionaries:
+        blob = get_bucket().blob(f"{root_dir}/{DICTIONARY_DIR}/{dict_id}.zdict")
+        dictionaries[dict_id] = zstandard.ZstdCompressionDict(blob.download_as_bytes())
+    return dictionaries[dict_id]
+
+
+def upload_zstd_dictionary(root_dir, dictionary):
+    """Stores a trained zstd dictionary, so uploads can use it and downloads can find it by id."""
+    blob = get_bucket().blob(f"{root_dir}/{DICTIONARY_DIR}/{dictionary.dict_id()}.zdict")
+    blob.upload_from_string(dictionary.as_bytes())
+    _storage['dictionaries'][dictionary.dict_id()] = dictionary
+    return blob
+
+
+def get_model_compression(root_dir):
+    """Returns the (compression, level, zstd dictionary) 3D models are uploaded with."""
+    settings = st.secrets['gcp']
+    compress = settings.get('model_compression', 'gzip')
+    dict_id = settings.get('zstd_dictionary') if compress == 'zstd' else None
+    return compress, settings.get('compression_level'), get_zstd_dictionary(root_dir, dict_id) if dict_id else None
+
+
+def get_image_max_side():
+    """Returns the longest side images are scaled down to on upload, 0 for the full resolution."""
+    return st.secrets['gcp'].get('image_max_side', file_io.IMAGE_MAX_SIDE)
+
+
+def _load_upload_sessions():
+    try:
+        with open(UPLOAD_SESSIONS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-def init():
-    creds_str = credential.google_creds()
-
-    if not os.path.exists('temp'):
-        os.makedirs('temp')
 
-    with open('temp/google-credentials.json', 'w') as f:
-        json.dump(creds_str, f)
+def get_upload_session(key):
+    """Returns the session URI persisted for an unfinished upload, or None."""
+    with _upload_sessions_lock:
+        return _load_upload_sessions().get(key)
 
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'temp/google-credentials.json'
-    storage_client = storage.Client()
-    st.session_state['storage_client'] = storage_client
 
+def set_upload_session(key, url):
+    """Persists the session URI of an upload, or forgets it if url is None."""
+    with _upload_sessions_lock:
+        sessions = _load_upload_sessions()
+        if url is None:
+            sessions.pop(key, None)
+        else:
+            sessions[key] = url
+        os.makedirs(os.path.dirname(UPLOAD_SESSIONS_PATH), exist_ok=True)
+        # write to a temporary file first, so a crash never leaves a truncated file behind
+        with open(f"{UPLOAD_SESSIONS_PATH}.tmp", 'w') as f:
+            json.dump(sessions, f)
+        os.replace(f"{UPLOAD_SESSIONS_PATH}.tmp", UPLOAD_SESSIONS_PATH)
+
+
+def _parse_upload_response(response):
+    """Returns (bytes persisted by the session, object resource once the upload is complete)."""
+    if response.status_code in [200, 201]:
+        resource = response.json()
+        return int(resource['size']), resource
+    if response.status_code == 308:
+        # "bytes=0-N" once anything is persisted
+        persisted = response.headers.get('Range')
+        return (int(persisted.split('-')[1]) + 1 if persisted else 0), None
+    response.raise_for_status()
+    raise requests.HTTPError(f'Unexpected upload response: {response.status_code}', response=response)
+
+
+def get_upload_status(http, url):
+    """Asks the upload session how much it has persisted. Raises HTTPError if the session expired."""
+    response = http.put(url, headers={'Content-Range': 'bytes */*'}, timeout=UPLOAD_TIMEOUT)
+    return _parse_upload_response(response)
+
+
+def _send_chunk(http, url, chunk, offset, final):
+    """Sends the chunk starting at `offset` with retries and returns the new offset and the object, if done."""
+    end = offset + len(chunk)
+    total = end if final else '*'
+    start = offset
+    attempt = 0
+    while True:
+        try:
+            if attempt:
+                start, resource = get_upload_status(http, url)
+                if resource is not None:
+                    return start, resource
+            data = chunk[start - offset:]
+            content_range = f'bytes {start}-{end - 1}/{total}' if data else f'bytes */{total}'
+            response = http.put(url, data=data, headers={'Content-Range': content_range}, timeout=UPLOAD_TIMEOUT)
+            start, resource = _parse_upload_response(response)
+            if resource is not None or start == end:
+                return start, resource
+            # the session persisted only part of the chunk, the rest is sent again right away
+            attempt = 0
+            continue
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == UPLOAD_RETRIES:
+                raise
+        except requests.HTTPError as e:
+            if attempt == UPLOAD_RETRIES or e.response is None or e.response.status_code not in RETRYABLE_STATUS:
+                raise
+        time.sleep(UPLOAD_BACKOFF * 2 ** attempt + random.uniform(0, UPLOAD_BACKOFF))
+        attempt += 1
+
+
+def upload_resumable(blob, data, session_key, chunk_size=UPLOAD_CHUNK_SIZE, on_chunk=None):
+    """Uploads the iterable of bytes through a resumable session, resuming the one of `session_key`."""
+    http = blob.bucket.client._http
+    url = get_upload_session(session_key)
+    offset, resource = 0, None
+    if url:
+        try:
+            offset, resource = get_upload_status(http, url)
+        except requests.HTTPError:
+            # the session expired, start over
+            url = None
+    if url is None:
+        url = blob.create_resumable_upload_session()
+        set_upload_session(session_key, url)
 
-def upload_to_bucket(root_dir, file, uid, name, metadata=None, compress=None):
-    dir = f"{root_dir}/{uid}"
     try:
-        # get file extension
-        extension = os.path.splitext(file.name)[1]
-        filename = name + extension
-
-        compressed_file_path = None
-
-        if compress:
-            # Compress file
-            if compress == 'gzip':
-                compressed_file_path = file_io.compress_to_gzip(file)
-                filename += '.gz'  # Add '.gz' extension to the filename
-            elif compress == 'xz':
-                compressed_file_path = file_io.compress_to_xz(file)
-                filename += '.xz'  # Add '.xz' extension to the filename
-            else:
-                raise ValueError(f'Unsupported compression type: {compress}. Supported types are "gzip" and "xz".'
-                                 f'if you do not want to compress the file, set compress=None')
-
-        storage_client = st.session_state['storage_client']
-        bucket = storage_client.get_bucket(st.secrets['gcp']['bucket_name'])
-        blob = bucket.blob(f"{dir}/{filename}")
-
-        if compress:
-            # Open the compressed file in read-binary mode for upload
-            with open(compressed_file_path, 'rb') as file_obj:
-                file_content = file_obj.read()  # read file content once
-
-                default_meta = {
-                    'md5_hash': utils.calculate_md5(file_content),
-                    'size': utils.calculate_size(file_content),
-                    'owner': st.session_state['student_number'],
-                    'time': utils.get_current_time()
-                }
-                # Merge the default metadata with the given metadata
-                meta = {**default_meta, **metadata} if metadata else default_meta
-
-                # Set the blob metadata
-                blob.metadata = meta
-
-                blob.upload_from_file(io.BytesIO(file_content))
-            # Delete the compressed file
-            os.remove(compressed_file_path)
-        else:
-            # If compress is None or False, upload the file as is
-            # Convert file_content to a BytesIO object and upload
-            file_content = file.read()
-            default_meta = {
-                'md5_hash': utils.calculate_md5(file_content),
-                'size': utils.calculate_size(file_content),
-                'owner': st.session_state['student_number'],
-                'time': utils.get_current_time()
-            }
+        skip = offset
+        buffer = bytearray()
+        for piece in data:
+            if resource is not None:
+                # already complete, the data is only read to the end
+                continue
+            if skip:
+                # the session already holds the start of the data
+                dropped = min(skip, len(piece))
+                piece = piece[dropped:]
+                skip -= dropped
+            buffer += piece
+            # a part is only sent once more data follows it, so the last part knows the total size
+            while len(buffer) > chunk_size:
+                offset, resource = _send_chunk(http, url, bytes(buffer[:chunk_size]), offset, final=False)
+                del buffer[:chunk_size]
+                if on_chunk:
+                    on_chunk(offset)
+        if resource is None:
+            offset, resource = _send_chunk(http, url, bytes(buffer), offset, final=True)
+            if on_chunk:
+                on_chunk(offset)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code not in RETRYABLE_STATUS:
+            # the session rejected the data, a retry has to start a new one
+            set_upload_session(session_key, None)
+        raise
+    set_upload_session(session_key, None)
+    return resource
+
+
+def get_blob_filename(file_name, name, compress=None):
+    """Returns the name a file is uploaded under: the name, the file's extension, then the compression's."""
+    # get file extension
+    filename = name + os.path.splitext(file_name)[1]
+    if compress:
+        if compress not in file_io.STREAM_COMPRESSORS:
+            raise ValueError(f'Unsupported compression type: {compress}. Supported types are "gzip", "xz" and "zstd".'
+                             f'if you do not want to compress the file, set compress=None')
+        filename += file_io.COMPRESSED_EXTENSIONS[compress]
+    return filename
+
+
+def upload_blob(bucket, root_dir, file, uid, name, owner, metadata=None, compress=None, level=None, dictionary=None,
+                progress=None):
+    """Uploads the file to the bucket and returns the blob, raising on failure."""
+    dir = f"{root_dir}/{uid}"
+    blob = bucket.blob(f"{dir}/{get_blob_filename(file.name, name, compress)}")
+    default_meta = {
+        'owner': owner,
+        'time': utils.get_current_time()
+    }
+
+    if compress:
+        # Compress the file straight into a resumable upload, one chunk at a time. The hashes and sizes are only
+        # known once the stream is done, so they are patched into the metadata afterwards.
+        default_meta['compression'] = compress
+        if level is not None:
+            default_meta['compression_level'] = level
+        if dictionary is not None:
+            default_meta['zstd_dict_id'] = dictionary.dict_id()
+        blob.metadata = {**default_meta, **metadata} if metadata else default_meta
+        file_size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+        digests = {}
+
+        def on_chunk(uploaded):
+            if progress:
+                progress(digests['original_size'], file_size)
+
+        resource = upload_resumable(blob, file_io.iter_compress(file, digests, compress, level, dictionary),
+                                    f"{bucket.name}/{blob.name}:{file_size}", on_chunk=on_chunk)
+        # a resumed upload only matches if it was resumed with the same file
+        md5_hash = base64.b64encode(bytes.fromhex(digests['md5_hash'])).decode()
+        if 'md5Hash' in resource and resource['md5Hash'] != md5_hash:
+            blob.delete()
+            raise ValueError(f'Uploaded {blob.name} does not match the file, please submit again.')
+        # Merge the default metadata with the given metadata
+        blob.metadata = {**digests, **default_meta, **metadata} if metadata else {**digests, **default_meta}
+        blob.patch()
+    else:
+        # If compress is None or False, upload the file as is
+        # Convert file_content to a BytesIO object and upload
+        file_content = file.read()
+        default_meta = {
+            'md5_hash': utils.calculate_md5(file_content),
+            'size': utils.calculate_size(file_content),
+            **default_meta
+        }
+
+        # Merge the default metadata with the given metadata
+        meta = {**default_meta, **metadata} if metadata else default_meta
+
+        # Set the blob metadata
+        blob.metadata = meta
 
-            # Merge the default metadata with the given metadata
-            meta = {**default_meta, **metadata} if metadata else default_meta
+        blob.upload_from_file(io.BytesIO(file_content))
+    return blob
 
-            # Set the blob metadata
-            blob.metadata = meta
 
-            blob.upload_from_file(io.BytesIO(file_content))
+def get_thumbnail_name(blob_name, size):
+    """Returns the name of the thumbnail of the size of an image blob."""
+    folder, filename = blob_name.rsplit('/', 1)
+    return f"{folder}/{THUMBNAIL_DIR}/{os.path.splitext(filename)[0]}-{size}.webp"
 
+
+def upload_thumbnails(bucket, root_dir, thumbnails, uid, name, owner):
+    """Uploads the thumbnails of the image and returns the metadata pointing the image at them."""
+    urls = {}
+    for size, thumbnail in thumbnails.items():
+        blob = upload_blob(bucket, root_dir, thumbnail, f"{uid}/{THUMBNAIL_DIR}", f"{name}-{size}", owner,
+                           metadata={'category': 'thumbnail'})
+        urls[f'thumbnail_{size}'] = blob.public_url
+    return urls
+
+
+def upload_to_bucket(root_dir, file, uid, name, metadata=None, compress=None, level=None, dictionary=None):
+    """Uploads the file to the bucket and returns the uploaded blob, with its properties and metadata loaded."""
+    try:
+        return upload_blob(get_bucket(), root_dir, file, uid, name, st.session_state['student_number'],
+                           metadata=metadata, compress=compress, level=level, dictionary=dictionary)
     except Exception as e:
         tb = traceback.format_exc()
         st.error(f'❌Failed to upload to the bucket: **{e}** \n\n **Traceback**:\n ```{tb}```')
         st.stop()
 
 
-def delete_from_bucket(root_dir, filenames, uid):
-    for filename in filenames:
-        # Decode the filename to ensure spaces are handled correctly
-        decoded_filename = urllib.parse.unquote(filename)
+def list_item_blobs(bucket, root_dir, uid):
+    """Lists every blob stored under the item's folder. Raises ValueError for a reserved folder."""
+    if uid in RESERVED_UIDS:
+        raise ValueError(f"{root_dir}/{uid}/ is not an item folder")
+    return list(bucket.list_blobs(prefix=f"{root_dir}/{uid}/"))
+
+
+def delete_item_blobs(bucket, root_dir, uids):
+    """Deletes the blobs of the items and returns {uid: error} for the items not fully deleted."""
+    errors = {}
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        listings = {uid: executor.submit(list_item_blobs, bucket, root_dir, uid) for uid in uids}
+        blobs = {}
+        for uid, future in listings.items():
+            try:
+                blobs[uid] = future.result()
+            except Exception as e:
+                errors[uid] = f"failed to list blobs: {e}"
+
+        pending = [blob for item_blobs in blobs.values() for blob in item_blobs]
+        failed = False
+        for start in range(0, len(pending), DELETE_BATCH_SIZE):
+            try:
+                with bucket.client.batch():
+                    for blob in pending[start:start + DELETE_BATCH_SIZE]:
+                        blob.delete()
+            except Exception:
+                failed = True
+
+        if failed:
+            # a batch only reports its last error, check which folders are empty now
+            remaining = {uid: executor.submit(list_item_blobs, bucket, root_dir, uid) for uid in blobs}
+            for uid, future in remaining.items():
+                try:
+                    left = future.result()
+                    if left:
+                        errors[uid] = f"failed to delete {len(left)} blobs"
+                except Exception as e:
+                    errors[uid] = f"failed to confirm deletion: {e}"
+    return errors
+
+
+def get_cached_asset(md5, extension):
+    """Returns the path of the cached copy of the asset, or None if it is not cached."""
+    path = os.path.join(ASSET_CACHE_DIR, f"{md5}{extension}")
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def evict_asset_cache(limit=ASSET_CACHE_LIMIT):
+    """Deletes the least recently used assets until the cache fits in the limit, in bytes."""
+    entries = []
+    for entry in os.scandir(ASSET_CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith('.part'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
         try:
-            storage_client = st.session_state['storage_client']
-            bucket = storage_client.get_bucket(st.secrets['gcp']['bucket_name'])
-            blob = bucket.blob(f"{root_dir}/{uid}/{decoded_filename}")
-            blob.delete()
-        except Exception as e:
-            st.error(f'failed to delete file ({root_dir}/{uid}/{decoded_filename}) from bucket. **{e}**')
-            st.stop()
-
-
-def download_from_bucket(root_dir, filename, uid):
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def _download_range(blob, path, start, end):
+    """Downloads the bytes start..end (inclusive) of the blob into the same place of the file."""
+    data = blob.download_as_bytes(start=start, end=end, raw_download=True, checksum=None,
+                                  if_generation_match=blob.generation)
+    with open(path, 'r+b') as f:
+        f.seek(start)
+        f.write(data)
+
+
+def download_blob(blob, path):
+    """Downloads the blob to the path, in parallel byte ranges for large blobs."""
+    if blob.size is None or blob.size <= RANGE_THRESHOLD:
+        with open(path, 'wb') as f:
+            blob.download_to_file(f, raw_download=True)
+        return
+
+    with open(path, 'wb') as f:
+        f.truncate(blob.size)
+    with ThreadPoolExecutor(max_workers=RANGE_WORKERS) as executor:
+        futures = [executor.submit(_download_range, blob, path, start, min(start + RANGE_SIZE, blob.size) - 1)
+                   for start in range(0, blob.size, RANGE_SIZE)]
+        for future in futures:
+            future.result()
+
+    if blob.md5_hash:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(file_io.STREAM_CHUNK_SIZE), b''):
+                md5.update(chunk)
+        if base64.b64encode(md5.digest()).decode() != blob.md5_hash:
+            os.remove(path)
+            raise ValueError(f'Downloaded {blob.name} does not match its md5.')
+
+
+def _download_to_cache(root_dir, filename, uid, md5, cache_limit):
+    """Returns the path of the cached copy of the file, downloading it on a miss."""
+    # keep the file type in the cached name, e.g. .3dm.gz
+    stem, extension = os.path.splitext(filename)
+    if extension in file_io.COMPRESSED_EXTENSIONS.values():
+        extension = os.path.splitext(stem)[1] + extension
+    if md5:
+        path = get_cached_asset(md5, extension)
+        if path:
+            return path
+
+    blob = get_bucket().blob(f"{root_dir}/{uid}/{filename}")
+    blob.reload()
+    md5 = base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None
+    path = get_cached_asset(md5, extension) if md5 else None
+    if path:
+        return path
+
+    os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+    # download next to the cache and move it in once complete, so a partial download is never served
+    part_path = os.path.join(ASSET_CACHE_DIR, f"{uuid.uuid4().hex}.part")
     try:
-        storage_client = st.session_state['storage_client']
-        bucket = storage_client.get_bucket(st.secrets['gcp']['bucket_name'])
-        blob = bucket.blob(f"{root_dir}/{uid}/{filename}")
-
-        if not os.path.exists('temp'):
-            os.makedirs('temp')
-
-        with open(f"temp/{filename}", 'wb') as f:
-            storage_client.download_blob_to_file(blob, f)
-        return f"temp/{filename}"
+        download_blob(blob, part_path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    # make room first, so the new asset is never the one evicted
+    evict_asset_cache(cache_limit - os.path.getsize(part_path))
+    path = os.path.join(ASSET_CACHE_DIR, f"{md5 or uuid.uuid4().hex}{extension}")
+    os.replace(part_path, path)
+    return path
+
+
+def decompress_asset(root_dir, path, cache_limit=ASSET_CACHE_LIMIT):
+    """Decompresses a cached asset and returns the path of the original."""
+    compress = file_io.get_compression(path)
+    if compress is None:
+        return path
+    original_path = path[:-len(file_io.COMPRESSED_EXTENSIONS[compress])]
+    if os.path.exists(original_path):
+        os.utime(original_path)
+        return original_path
+
+    part_path = os.path.join(ASSET_CACHE_DIR, f"{uuid.uuid4().hex}.part")
+    try:
+        with open(path, 'rb') as f, open(part_path, 'wb') as out:
+            dictionary = None
+            if compress == 'zstd':
+                dict_id = file_io.get_zstd_dictionary_id(f)
+                dictionary = get_zstd_dictionary(root_dir, dict_id) if dict_id else None
+            for data in file_io.iter_decompress(f, compress, dictionary):
+                out.write(data)
+    except Exception:
+        os.remove(part_path)
+        raise
+    evict_asset_cache(cache_limit - os.path.getsize(part_path))
+    os.replace(part_path, original_path)
+    return original_path
+
+
+def download_from_bucket(root_dir, filename, uid, md5=None, cache_limit=ASSET_CACHE_LIMIT, decompress=False):
+    """Downloads the file to the local asset cache and returns the path of the cached copy."""
+    try:
+        path = _download_to_cache(root_dir, filename, uid, md5, cache_limit)
+        return decompress_asset(root_dir, path, cache_limit) if decompress else path
     except Exception as e:
         st.error(f'failed to download file from bucket. **{e}**')
         st.stop()
@@ -151,6 +577,13 @@ def get_public_urls_from_blobs(blobs):
     return [blob.public_url for blob in blobs]
 
 
+def get_blob_name_from_url(bucket, url):
+    """Returns the name of the blob behind a public url of the bucket."""
+    if not isinstance(url, str) or f"/{bucket.name}/" not in url:
+        raise ValueError(f"{url!r} is not a url of the bucket {bucket.name}")
+    return urllib.parse.unquote(url.split(f"/{bucket.name}/", 1)[1])
+
+
 def get_blob_md5(blobs):
     return [blob.md5_hash for blob in blobs]
 
@@ -159,16 +592,116 @@ def get_blob_metadata(blobs):
     return [blob.metadata for blob in blobs]
 
 
-def get_blob_info(root_dir, uid, name_pattern, extensions, infos):
-    storage_client = st.session_state['storage_client']
-    bucket = storage_client.get_bucket(st.secrets['gcp']['bucket_name'])
-    dir = f"{root_dir}/{uid}"
+def get_blob_category(blob):
+    """Returns the asset category of the blob from its file extension, or None if it is not an asset."""
+    for category, extensions in CATEGORY_EXTENSIONS.items():
+        if any(blob.name.endswith(extension) for extension in extensions):
+            return category
+    return None
+
+
+def get_blob_info(root_dir, uid, name_pattern, infos, blobs=None):
+    """Returns the requested infos of the item's blobs grouped by category."""
+    if blobs is None:
+        extensions = [extension for extensions in CATEGORY_EXTENSIONS.values() for extension in extensions]
+        blobs = get_blobs(get_bucket(), f"{root_dir}/{uid}", name_pattern, extensions)
+
+    blob_info = {category: {info: [] for info in infos} for category in CATEGORY_EXTENSIONS}
+    # listed blobs come in name order, given blobs keep their order, e.g. content-addressed images named by hash
+    for blob in blobs:
+        category = get_blob_category(blob)
+        if category is None:
+            continue
+        for info in infos:
+            if info == 'url':
+                blob_info[category][info].append(blob.public_url)
+            else:
+                blob_info[category][info].append((blob.metadata or {}).get(info))
+    return blob_info
 
-    blobs = get_blobs(bucket, dir, name_pattern, extensions)
 
-    for info in infos:
-        if info == 'url':
-            return get_public_urls_from_blobs(blobs)
-        else:
-            metas = get_blob_metadata(blobs)
-            return [meta[info] for meta in metas]
+def _put_chunk(chunks, item, cancelled):
+    """Waits for room in the queue, unless the bundle was cancelled. Returns False if it was."""
+    while not cancelled.is_set():
+        try:
+            chunks.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _fetch_chunks(bucket, blob_name, chunks, cancelled, chunk_size):
+    """Reads the blob in chunks into the queue, then None. A failure is put in the queue instead."""
+    try:
+        with bucket.blob(blob_name).open('rb', chunk_size=chunk_size) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                if not _put_chunk(chunks, chunk, cancelled):
+                    return
+        _put_chunk(chunks, None, cancelled)
+    except Exception as e:
+        _put_chunk(chunks, e, cancelled)
+
+
+def write_bundle(bucket, files, path, progress=None, chunk_size=BUNDLE_CHUNK_SIZE, workers=BUNDLE_WORKERS,
+                 max_size=None):
+    """Streams the blobs into a ZIP with a manifest.json at path and returns the manifest."""
+    # one bounded queue per blob, the blobs are fetched in order so the one being written is always in flight
+    queues = [queue.Queue(maxsize=BUNDLE_QUEUE_DEPTH) for _ in files]
+    cancelled = threading.Event()
+    manifest = []
+    total_size = 0
+    part_path = f"{path}.{uuid.uuid4().hex}.part"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for (_, blob_name), chunks in zip(files, queues):
+                executor.submit(_fetch_chunks, bucket, blob_name, chunks, cancelled, chunk_size)
+            # the assets are compressed already
+            with zipfile.ZipFile(part_path, 'w', zipfile.ZIP_STORED) as bundle:
+                for n, ((name, blob_name), chunks) in enumerate(zip(files, queues), start=1):
+                    md5 = hashlib.md5()
+                    size = 0
+                    with bundle.open(name, 'w', force_zip64=True) as entry:
+                        while True:
+                            chunk = chunks.get()
+                            if chunk is None:
+                                break
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            size += len(chunk)
+                            if max_size is not None and total_size + size > max_size:
+                                raise ValueError(f"the files add up to more than {max_size / 1024 ** 2:.0f}MB, "
+                                                 f"bundle fewer items")
+                            entry.write(chunk)
+                            md5.update(chunk)
+                    total_size += size
+                    manifest.append({'path': name, 'blob': blob_name, 'md5': md5.hexdigest(), 'size': size})
+                    if progress:
+                        progress(n, len(files))
+                bundle.writestr('manifest.json', json.dumps(manifest, indent=2))
+        except BaseException:
+            # stop the fetches waiting on a full queue
+            cancelled.set()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+    os.replace(part_path, path)
+    return manifest
+
+
+def get_bundle(bucket, files, key, progress=None, max_size=BUNDLE_MAX_SIZE):
+    """Returns the path of the ZIP bundle of the files, writing it unless it is on disk already."""
+    path = os.path.join(BUNDLE_DIR, f"{key}.zip")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    write_bundle(bucket, files, path, progress, max_size=max_size)
+    bundles = sorted((entry for entry in os.scandir(BUNDLE_DIR) if entry.name.endswith('.zip')),
+                     key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in bundles[BUNDLE_CACHE_ENTRIES:]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+    return path
@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import subprocess
+
+# durable queue of the submissions run by worker.py, shared by every app session on this machine
+JOB_DB_PATH = 'cache/jobs.sqlite3'
+# uploaded files are copied here until their job is done, so a failed job can be retried without the browser
+JOBS_DIR = 'cache/jobs'
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'worker.py')
+WORKER_LOG_PATH = 'cache/worker.log'
+# a worker that has not beaten for this long is considered dead
+WORKER_TIMEOUT = 30
+# a running job whose worker has not reported for this long is handed to another worker
+STALE_AFTER = 5 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '',
+    checkpoint TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created);
+CREATE TABLE IF NOT EXISTS job_assets (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    blob_name TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    pid INTEGER PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+
+def _connect(path=JOB_DB_PATH):
+    """Opens the queue, creating it on first use. Autocommit, so each statement is its own transaction."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # readers do not block the worker's writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def enqueue(kind, owner, payload, files=None):
+    """Queues a job, copying its uploaded files to the job's folder, and returns its id."""
+    job_id = uuid.uuid4().hex
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    for key, uploaded_files in (files or {}).items():
+        payload[key] = []
+        for n, uploaded_file in enumerate(uploaded_files):
+            os.makedirs(job_dir, exist_ok=True)
+            # keep the extension, it decides the blob name and category
+            path = os.path.join(job_dir, f"{key}-{n:02d}{os.path.splitext(uploaded_file.name)[1]}")
+            uploaded_file.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(uploaded_file, f)
+            payload[key].append({'path': path, 'name': uploaded_file.name})
+
+    now = time.time()
+    with _connect() as conn:
+        conn.execute('INSERT INTO jobs (id, kind, owner, status, payload, created, updated) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', (job_id, kind, owner, 'queued', json.dumps(payload), now, now))
+    return job_id
+
+
+def get_job(job_id):
+    """Returns the job, or None if it does not exist."""
+    with _connect() as conn:
+        return _to_job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+
+def list_jobs(owner, limit=10):
+    """Returns the latest jobs of the owner, newest first."""
+    with _connect() as conn:
+        rows = conn.execute('SELECT * FROM jobs WHERE owner = ? ORDER BY created DESC LIMIT ?', (owner, limit))
+        return [_to_job(row) for row in rows]
+
+
+def claim_job():
+    """Marks the oldest queued or stalled job as running and returns it, or None."""
+    now = time.time()
+    with _connect() as conn:
+        # take the write lock up front, so two workers never claim the same job
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND updated < ?) "
+                               "ORDER BY created LIMIT 1", (now - STALE_AFTER,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, error = NULL, "
+                             "updated = ? WHERE id = ?", (now, row['id']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    return get_job(row['id']) if row is not None else None
+
+
+def set_progress(job_id, progress):
+    with _connect() as conn:
+        conn.execute('UPDATE jobs SET progress = ?, updated = ? WHERE id = ?', (progress, time.time(), job_id))
+
+
+def set_checkpoint(job_id, checkpoint):
+    """Records the last step the job completed, so a retry can skip it."""
+    with _connect() as conn:
+        conn.execute('UPDATE jobs SET checkpoint = ?, updated = ? WHERE id = ?', (checkpoint, time.time(), job_id))
+
+
+def record_asset(job_id, position, blob):
+    """Records an uploaded asset of the job, so a retry does not upload it again."""
+    with _connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO job_assets (job_id, position, blob_name, metadata) VALUES (?, ?, ?, ?)',
+                     (job_id, position, blob.name, json.dumps(blob.metadata or {})))
+        conn.execute('UPDATE jobs SET updated = ? WHERE id = ?', (time.time(), job_id))
+
+
+def get_recorded_assets(job_id):
+    """Returns the assets the job already uploaded as {position: (blob name, metadata)}."""
+    with _connect() as conn:
+        rows = conn.execute('SELECT * FROM job_assets WHERE job_id = ?', (job_id,))
+        return {row['position']: (row['blob_name'], json.loads(row['metadata'])) for row in rows}
+
+
+def finish_job(job_id, result):
+    """Marks the job done and removes its files."""
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET status = 'done', progress = '', result = ?, updated = ? WHERE id = ?",
+                     (json.dumps(result), time.time(), job_id))
+        conn.execute('DELETE FROM job_assets WHERE job_id = ?', (job_id,))
+    shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+
+
+def fail_job(job_id, error):
+    """Marks the job failed. Its files and uploaded assets are kept for a retry."""
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                     (error, time.time(), job_id))
+
+
+def retry_job(job_id):
+    """Queues a failed job again. Returns False if the job is not failed."""
+    with _connect() as conn:
+        cursor = conn.execute("UPDATE jobs SET status = 'queued', updated = ? WHERE id = ? AND status = 'failed'",
+                              (time.time(), job_id))
+        return cursor.rowcount == 1
+
+
+def is_stalled(job):
+    """Returns True if the job is waiting or running but no worker has reported on it for WORKER_TIMEOUT seconds."""
+    return job['status'] in ['queued', 'running'] and time.time() - job['updated'] > WORKER_TIMEOUT
+
+
+def heartbeat(pid, job_id=None):
+    """Reports the worker alive, and keeps the job it is running from being handed to another worker."""
+    now = time.time()
+    with _connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO workers (pid, heartbeat) VALUES (?, ?)', (pid, now))
+        if job_id:
+            conn.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running'", (now, job_id))
+
+
+def remove_worker(pid):
+    with _connect() as conn:
+        conn.execute('DELETE FROM workers WHERE pid = ?', (pid,))
+
+
+def ensure_worker():
+    """Starts a worker process unless one has beaten recently."""
+    with _connect() as conn:
+        alive = conn.execute('SELECT COUNT(*) FROM workers WHERE heartbeat > ?',
+                             (time.time() - WORKER_TIMEOUT,)).fetchone()[0]
+    if alive:
+        return
+    with open(WORKER_LOG_PATH, 'a') as log:
+        subprocess.Popen([sys.executable, WORKER_SCRIPT], stdout=log, stderr=subprocess.STDOUT,
+                         stdin=subprocess.DEVNULL, start_new_session=True)
+    print(f'started job worker {WORKER_SCRIPT}')
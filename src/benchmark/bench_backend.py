@@ -0,0 +1,239 @@
+"""Offline benchmark suite for db_handler and gcp_handler, run against the Firestore emulator and a local GCS
+stand-in instead of the production project.
+
+Start the emulators, then run the suite from the repository root:
+    gcloud emulators firestore start --host-port=localhost:8080
+    docker run -p 4443:4443 fsouza/fake-gcs-server -scheme http
+    FIRESTORE_EMULATOR_HOST=localhost:8080 STORAGE_EMULATOR_HOST=http://localhost:4443 \
+        python src/benchmark/bench_backend.py --items 2000 --users 50 --output bench_backend.json
+
+Results are written as JSON. Pass --compare with the results of an earlier version to print the change per operation.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit as st
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore, storage
+
+ROOT = 'Benchmark'
+
+
+def make_item(n, bucket_name):
+    """Builds a synthetic item document shaped like the ones main.submit_form writes."""
+    uid = f"bench-{n:08d}"
+    base_url = f"https://storage.googleapis.com/{bucket_name}/{ROOT}/{uid}"
+    return uid, {
+        'spec_id': f"W{n % 100:02d}-F",
+        'name': f"component {n}",
+        'material': ['Timber', 'Steel', 'Glass', 'Brick'][n % 4],
+        'amount': n % 50 + 1,
+        'unit': 'piece',
+        'notes': '',
+        'images': [f"{base_url}/item-{n}-{i:02d}.webp" for i in range(n % 4)],
+        '3d_model': [f"{base_url}/item-{n}.3dm.gz"],
+        'original_md5': ['0' * 32],
+        'md5_hash': ['0' * 32],
+        'time': datetime.now(timezone.utc),
+        'model_scale': '1:1',
+        'source_name': 'Queen Victoria Market',
+        'source_year': 2023,
+        'source_country': 'Australia',
+        'source_state': 'Victoria',
+        'source_city': 'Melbourne',
+        'owner': ''
+    }
+
+
+def seed_inventory(db_handler, db, items, users, bucket_name):
+    """Writes a synthetic inventory of `items` items spread over `users` users."""
+    batch = db.batch()
+    pending = 0
+    for n in range(items):
+        student_number = f"s{n % users:07d}"
+        user_ref = db.collection('Users').document(student_number)
+        if n < users:
+            batch.set(user_ref, {'access': 'user'})
+            pending += 1
+        uid, item = make_item(n, bucket_name)
+        batch.set(user_ref.collection('Items').document(uid), {**item, 'owner': student_number})
+        pending += 1
+        if pending >= db_handler.BATCH_LIMIT - 1:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+
+
+def named_file(content, name):
+    """An in-memory file with a name, like the streamlit UploadedFile the app passes to gcp_handler."""
+    file = io.BytesIO(content)
+    file.name = name
+    return file
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'runs': len(timings),
+        'mean': statistics.mean(timings),
+        'median': statistics.median(timings),
+        'p95': timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))],
+        'min': timings[0],
+        'max': timings[-1]
+    }
+
+
+def timed(timings, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.append(time.perf_counter() - start)
+    return result
+
+
+def run_suite(db_handler, gcp_handler, args):
+    """Times each backend operation and returns the timings per operation."""
+    results = {name: [] for name in ['get_data_cold', 'get_data_delta', 'set_data', 'update_data', 'delete_data',
+                                     'upload_to_bucket_image', 'upload_to_bucket_model_gzip', 'get_blob_info']}
+    image = os.urandom(args.image_kb * 1024)
+    model = os.urandom(args.model_kb * 1024 // 2) * 2  # half repeated, so gzip has something to do
+
+    for run in range(args.repeat):
+        # full load, then a delta sync with nothing changed. The disk cache written by the previous run goes too,
+        # get_data would restore from it instead and revalidate in a background thread during the timings
+        db_handler.reset_snapshot()
+        if os.path.exists(db_handler.INVENTORY_CACHE_PATH):
+            os.remove(db_handler.INVENTORY_CACHE_PATH)
+        timed(results['get_data_cold'], db_handler.get_data, db_handler.TABLE_COLUMNS)
+        # get_data trusts a fresh snapshot, so time the delta sync it runs once SYNC_INTERVAL has passed
+        timed(results['get_data_delta'], db_handler.refresh_snapshot, st.session_state['db'])
+
+        uid, item = make_item(args.items + run, args.bucket)
+        filename = f"item-{args.items + run}"
+
+        timed(results['upload_to_bucket_image'], gcp_handler.upload_to_bucket, ROOT,
+              named_file(image, 'photo.webp'), uid, f"{filename}-00", metadata={'category': 'image'})
+        timed(results['upload_to_bucket_model_gzip'], gcp_handler.upload_to_bucket, ROOT,
+              named_file(model, 'model.3dm'), uid, filename, compress='gzip', metadata={'category': '3d_model'})
+        timed(results['get_blob_info'], gcp_handler.get_blob_info, ROOT, uid, f"{filename}*",
+              ['url', 'original_md5', 'md5_hash'])
+
+        item['images'] = [f"{filename}-00.webp"]
+        item['3d_model'] = [f"{filename}.3dm.gz"]
+        timed(results['set_data'], db_handler.set_data, item, uid)
+        timed(results['update_data'], db_handler.update_data, {'notes': f"run {run}"}, uid,
+              st.session_state['student_number'])
+        timed(results['delete_data'], db_handler.delete_data, uid, st.session_state['student_number'])
+
+    return {name: summarize(timings) for name, timings in results.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    for name, stats in results.items():
+        line = f"{name:>28}: median {stats['median'] * 1000:9.1f}ms  p95 {stats['p95'] * 1000:9.1f}ms"
+        if baseline and name in baseline:
+            line += f"  ({stats['median'] / baseline[name]['median']:.2f}x baseline)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1000, help='number of items in the synthetic inventory')
+    parser.add_argument('--users', type=int, default=50, help='number of users owning the items')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs per operation')
+    parser.add_argument('--image-kb', type=int, default=512, help='size of the uploaded image')
+    parser.add_argument('--model-kb', type=int, default=8192, help='size of the uploaded model')
+    parser.add_argument('--project', default='demo-mongrel-assemblies', help='emulator project id')
+    parser.add_argument('--bucket', default='benchmark', help='bucket created on the GCS stand-in')
+    parser.add_argument('--output', default='bench_backend.json', help='file the results are written to')
+    parser.add_argument('--compare', default=None, help='results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    for variable in ['FIRESTORE_EMULATOR_HOST', 'STORAGE_EMULATOR_HOST']:
+        if variable not in os.environ:
+            parser.error(f"{variable} is not set, refusing to run against a production project")
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    db = firestore.Client(project=args.project, credentials=AnonymousCredentials())
+    storage_client = storage.Client(project=args.project, credentials=AnonymousCredentials())
+    if storage_client.lookup_bucket(args.bucket) is None:
+        storage_client.create_bucket(args.bucket)
+
+    # the backend reads its clients and settings from the streamlit session and secrets
+    session_state = {
+        'db': db,
+        'storage_client': storage_client,
+        'student_number': 's0000000',
+        'db_root': ROOT,
+        'is_authenticated': True
+    }
+    secrets = {
+        'gcp': {'bucket_name': args.bucket},
+        'auth': {'admin': '', 'users': ['s0000000']},
+        # backend/sftp_op.py reads its settings on import
+        'sftp': {'host': '', 'username': '', 'password': '', 'port': 22, 'key_data': ''}
+    }
+    commit = git_commit()
+    cwd = os.getcwd()
+    # the disk cache and temp files go to a scratch directory
+    with tempfile.TemporaryDirectory() as scratch, \
+            mock.patch.object(st, 'session_state', session_state), \
+            mock.patch.object(st, 'secrets', secrets):
+        from backend import db_handler, gcp_handler
+        gcp_handler.init(storage_client)
+
+        print(f"Seeding {args.items} items for {args.users} users...")
+        seed_inventory(db_handler, db, args.items, args.users, args.bucket)
+        os.chdir(scratch)
+        try:
+            results = run_suite(db_handler, gcp_handler, args)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        'meta': {
+            'time': datetime.now(timezone.utc).isoformat(),
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'items': args.items,
+            'users': args.users,
+            'repeat': args.repeat,
+            'image_kb': args.image_kb,
+            'model_kb': args.model_kb
+        },
+        'results': results
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_results(results, baseline)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
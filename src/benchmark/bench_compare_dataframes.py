@@ -0,0 +1,96 @@
+"""Benchmarks the vectorized pd_table.compare_dataframes against the original iterrows implementation.
+
+    python src/benchmark/bench_compare_dataframes.py --rows 10000 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pd_table
+
+
+def legacy_compare_dataframes(df_original, df_modified):
+    """The original implementation, row by row and field by field."""
+    modified_data = []
+    for idx, row in df_original.iterrows():
+        if not row.equals(df_modified.loc[idx]):
+            modified_row = df_modified.loc[idx]
+            modified_fields = {field: modified_row[field] for field in df_original.columns if
+                               row[field] != modified_row[field]}
+            modified_data.append({
+                'uid': row['uid'],
+                'student_number': row['student_number'],
+                'modified_fields': modified_fields
+            })
+    return modified_data
+
+
+def make_inventory(rows, seed=0):
+    """Builds a synthetic inventory table shaped like the one pd_table.table edits."""
+    rng = np.random.default_rng(seed)
+    materials = np.array(['Timber', 'Steel', 'Glass', 'Plaster', 'Brick', 'Concrete', 'polymers', 'Other'])
+    df = pd.DataFrame({
+        'delete': False,
+        'student_number': [f"s{n:07d}" for n in rng.integers(0, 200, rows)],
+        'spec_id': [f"W{n:02d}-F" for n in rng.integers(0, 100, rows)],
+        'name': [f"component {n}" for n in range(rows)],
+        'uid': [f"{n:032x}" for n in range(rows)],
+        'material': materials[rng.integers(0, len(materials), rows)],
+        'amount': rng.integers(1, 50, rows),
+        'unit': 'piece',
+        'notes': '',
+        'source_year': rng.integers(1900, 2023, rows),
+        'source_latitude': rng.uniform(-90, 90, rows),
+        'source_longitude': rng.uniform(-180, 180, rows),
+        'model_scale': '1:1',
+    })
+    for n in range(3):
+        df[f'images_{n}'] = [f"https://storage.googleapis.com/bucket/{uid}/img-{n:02d}.webp" for uid in df['uid']]
+    df['3d_model_0'] = [f"https://storage.googleapis.com/bucket/{uid}/model.3dm.gz" for uid in df['uid']]
+    return df
+
+
+def make_edits(df, fraction, seed=1):
+    """Edits a fraction of the rows the way a user would in the data editor."""
+    rng = np.random.default_rng(seed)
+    edited = df.copy()
+    rows = rng.choice(len(df), size=max(1, int(len(df) * fraction)), replace=False)
+    edited.loc[edited.index[rows], 'amount'] += 1
+    edited.loc[edited.index[rows[::2]], 'notes'] = 'damaged'
+    edited.loc[edited.index[rows[::5]], 'delete'] = True
+    return edited
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000], help='table sizes to benchmark')
+    parser.add_argument('--fraction', type=float, default=0.01, help='fraction of rows edited')
+    parser.add_argument('--skip-legacy', action='store_true', help='only time the vectorized implementation')
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        df = make_inventory(rows)
+        edited = make_edits(df, args.fraction)
+
+        new_time, new_result = timed(pd_table.compare_dataframes, df, edited)
+        line = f"{rows:>8} rows, {len(new_result)} modified: vectorized {new_time:.3f}s"
+        if not args.skip_legacy:
+            legacy_time, legacy_result = timed(legacy_compare_dataframes, df, edited)
+            assert new_result == legacy_result, 'vectorized diff differs from the original implementation'
+            line += f", iterrows {legacy_time:.3f}s (x{legacy_time / new_time:.1f})"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Benchmarks the compressions 3D models can be uploaded with on a corpus of models, reporting the ratio and the
+compression and decompression speed of each, the way uploads stream them through file_io.
+
+    python src/benchmark/bench_compression.py path/to/models --modes gzip:9 xz:6 zstd:3 zstd:10 zstd:19
+    python src/benchmark/bench_compression.py path/to/models --dictionary trained.zdict
+
+Pass a dictionary, e.g. saved from scripts/train_zstd_dictionary.py, to also time every zstd mode with it.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zstandard
+import file_io
+
+
+def parse_mode(mode):
+    """Parses "compression:level", or a compression alone for its default level."""
+    compress, _, level = mode.partition(':')
+    if compress not in file_io.STREAM_COMPRESSORS:
+        raise argparse.ArgumentTypeError(f"unknown compression {compress!r}")
+    return compress, int(level) if level else None
+
+
+def run_mode(corpus, compress, level, dictionary):
+    """Compresses then decompresses every model, returning (compressed size, compress time, decompress time)."""
+    size = 0
+    compress_time = 0
+    decompress_time = 0
+    for content in corpus:
+        digests = {}
+        start = time.perf_counter()
+        compressed = b''.join(file_io.iter_compress(io.BytesIO(content), digests, compress, level, dictionary))
+        compress_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        decompressed = b''.join(file_io.iter_decompress(io.BytesIO(compressed), compress, dictionary))
+        decompress_time += time.perf_counter() - start
+        assert decompressed == content, f'{compress} did not round trip'
+        size += digests['size']
+    return size, compress_time, decompress_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='.3dm files or directories holding them')
+    parser.add_argument('--modes', type=parse_mode, nargs='+',
+                        default=[('gzip', 6), ('gzip', 9), ('xz', 6), ('zstd', 3), ('zstd', 10), ('zstd', 19)],
+                        help='compressions to benchmark as compression:level')
+    parser.add_argument('--dictionary', default=None, help='trained zstd dictionary to also benchmark zstd with')
+    args = parser.parse_args()
+
+    models = file_io.find_models(args.paths)
+    if not models:
+        parser.error('no .3dm files found')
+    # read up front so the disk is not timed
+    corpus = []
+    for model in models:
+        with open(model, 'rb') as f:
+            corpus.append(f.read())
+    original = sum(len(content) for content in corpus)
+    print(f"{len(corpus)} models, {original / 1e6:.1f}MB")
+
+    runs = [(compress, level, None) for compress, level in args.modes]
+    if args.dictionary:
+        with open(args.dictionary, 'rb') as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        runs += [(compress, level, dictionary) for compress, level in args.modes if compress == 'zstd']
+
+    for compress, level, dictionary in runs:
+        size, compress_time, decompress_time = run_mode(corpus, compress, level, dictionary)
+        name = f"{compress}:{'default' if level is None else level}{'+dict' if dictionary else ''}"
+        print(f"{name:>16}: ratio {original / size:6.2f}  compress {original / 1e6 / compress_time:8.1f}MB/s  "
+              f"decompress {original / 1e6 / decompress_time:8.1f}MB/s")
+
+
+if __name__ == '__main__':
+    main()
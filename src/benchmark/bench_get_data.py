@@ -0,0 +1,73 @@
+"""Benchmarks the collection group inventory loader against the old per-user loop.
+
+Run from the repository root so the streamlit secrets are found:
+    python src/benchmark/bench_get_data.py --repeat 5
+Set FIRESTORE_EMULATOR_HOST to run against the Firestore emulator instead of the production project.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+from firebase_admin import firestore
+from backend import db_handler
+
+
+def per_user_records(db):
+    """The original loader: one stream for Users, then one stream per user for its Items."""
+    users_ref = db.collection('Users')
+    data = []
+    for user_doc in users_ref.stream():
+        user_id = user_doc.id
+        for item_doc in users_ref.document(user_id).collection('Items').stream():
+            item_data = item_doc.to_dict()
+            item_data['uid'] = item_doc.id
+            item_data['student_number'] = user_id
+            data.append(item_data)
+    return data
+
+
+def collection_group_records(db):
+    """The new loader: a single paged collection group query over Items."""
+    return [db_handler.item_to_record(item_doc) for item_doc in db_handler.iter_items(db)]
+
+
+def time_loader(loader, db, repeat):
+    timings = []
+    data = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = loader(db)
+        timings.append(time.perf_counter() - start)
+    return timings, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per loader')
+    parser.add_argument('--app-name', default='benchmark', help='name of the firebase app to initialize')
+    args = parser.parse_args()
+
+    db = firestore.client(app=db_handler.get_init_firestore_app(args.app_name))
+
+    results = {}
+    frames = {}
+    for name, loader in [('per_user', per_user_records), ('collection_group', collection_group_records)]:
+        timings, data = time_loader(loader, db, args.repeat)
+        results[name] = timings
+        frames[name] = db_handler.records_to_dataframe(data, db_handler.TABLE_COLUMNS)
+        print(f"{name:>17}: {len(data)} items, best {min(timings):.3f}s, "
+              f"mean {sum(timings) / len(timings):.3f}s over {args.repeat} runs")
+
+    # both loaders must hand pd_table.table the exact same DataFrame
+    pd.testing.assert_frame_equal(frames['per_user'], frames['collection_group'])
+    print(f"DataFrames identical, speedup x{min(results['per_user']) / min(results['collection_group']):.2f}")
+
+    db_handler.close_app_if_exists(args.app_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,52 @@ import os
 import streamlit as st
 import json
 import io
-import gzip
+import zlib
 import lzma
+import hashlib
+import time
+import threading
+import multiprocessing
+import zstandard
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
 import pandas as pd
+import openpyxl
+import pyarrow.parquet as pq
+from pyarrow import feather
+from PIL import Image, ImageOps
+
+# size of the chunks read from an upload while it is compressed
+STREAM_CHUNK_SIZE = 1024 * 1024
+# default zstd level, a good ratio at several hundred MB/s over all cores
+ZSTD_LEVEL = 10
+# compressors for the streaming upload path, built from a level (None for the default) and an optional zstd
+# dictionary, and the extension each one adds
+STREAM_COMPRESSORS = {
+    # same level as gzip.open, wbits=31 writes a gzip header
+    'gzip': lambda level, dictionary: zlib.compressobj(9 if level is None else level, zlib.DEFLATED, 31),
+    'xz': lambda level, dictionary: lzma.LZMACompressor(preset=level),
+    # threads=-1 compresses on every core
+    'zstd': lambda level, dictionary: zstandard.ZstdCompressor(level=ZSTD_LEVEL if level is None else level,
+                                                               dict_data=dictionary, threads=-1).compressobj()
+}
+STREAM_DECOMPRESSORS = {
+    'gzip': lambda dictionary: zlib.decompressobj(31),
+    'xz': lambda dictionary: lzma.LZMADecompressor(),
+    'zstd': lambda dictionary: zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj()
+}
+COMPRESSED_EXTENSIONS = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+# longest side images are scaled down to before they are encoded
+IMAGE_MAX_SIDE = 2560
+# longest sides of the thumbnails made of each image, shown by the inventory table instead of the originals
+THUMBNAIL_SIZES = [128, 512]
+THUMBNAIL_QUALITY = 80
+# number of images decoded and encoded at once, one per core
+IMAGE_WORKERS = os.cpu_count()
+_image_pool = {'executor': None, 'lock': threading.Lock()}
+# fields of the items the model manifest of an export is built from
+MANIFEST_COLUMNS = ['uid', 'student_number', '3d_model', 'md5_hash', 'model_size']
 
 
 def _create_temp_dir():
@@ -28,6 +71,79 @@ def compress_image(image, quality=90, format='webp'):
     return f"temp/{filename}"
 
 
+def _draft_box(size, max_side):
+    """Returns the box in the aspect ratio of the image size whose longest side is max_side."""
+    width, height = size
+    longest = max(width, height)
+    return max(1, max_side * width // longest), max(1, max_side * height // longest)
+
+
+def encode_image(img_data: bytes, name, quality=90, format='webp', max_side=IMAGE_MAX_SIDE):
+    """Encodes the image upright and scaled down in memory and returns the file with an encode report."""
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(img_data))
+    original_resolution = image.size
+    if max_side:
+        # only JPEGs support draft mode, it decodes at 1/2, 1/4 or 1/8 scale instead of resizing afterwards
+        image.draft('RGB', _draft_box(image.size, max_side))
+    image = ImageOps.exif_transpose(image)
+    if max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format, optimize=True, quality=quality)
+    buffer.seek(0)  # reset pointer
+    buffer.name = f"{os.path.splitext(name)[0]}.{format}"
+    report = {
+        'name': name,
+        'original_size': len(img_data),
+        'original_resolution': original_resolution,
+        'size': buffer.getbuffer().nbytes,
+        'resolution': image.size,
+        'seconds': time.perf_counter() - start
+    }
+    return buffer, report
+
+
+def encode_thumbnails(img_data: bytes, name, sizes=THUMBNAIL_SIZES, quality=THUMBNAIL_QUALITY, format='webp'):
+    """Encodes upright thumbnails of the image and returns them as {size: named file}."""
+    image = Image.open(io.BytesIO(img_data))
+    image.draft('RGB', _draft_box(image.size, max(sizes)))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ['RGB', 'RGBA']:
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+
+    thumbnails = {}
+    # largest first, each thumbnail is scaled down from the previous one
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format, quality=quality)
+        buffer.seek(0)
+        buffer.name = f"{os.path.splitext(name)[0]}-{size}.{format}"
+        thumbnails[size] = buffer
+    return thumbnails
+
+
+def get_image_pool():
+    """Returns the process-wide pool images are encoded in."""
+    with _image_pool['lock']:
+        if _image_pool['executor'] is None:
+            _image_pool['executor'] = ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+    return _image_pool['executor']
+
+
+def format_image_report(report):
+    """Formats an encode report for the logs, e.g. "photo.jpg: 6000x4000 8.1MB -> 2560x1707 0.4MB in 0.52s"."""
+    return (f"{report['name']}: {report['original_resolution'][0]}x{report['original_resolution'][1]} "
+            f"{report['original_size'] / (1024 * 1024.0):.1f}MB -> "
+            f"{report['resolution'][0]}x{report['resolution'][1]} {report['size'] / (1024 * 1024.0):.1f}MB "
+            f"in {report['seconds']:.2f}s")
+
+
 @st.cache_data()
 def read_json(file, key: str = None):
     """Reads a json file and returns the value of a key."""
@@ -48,38 +164,166 @@ def read_csv(file):
     return df
 
 
-def export_to_csv(df, filename):
-    """Exports the data to a csv file."""
-    csv = df.to_csv(index=False)
-    st.download_button("📃Download CSV", csv, f"{filename}.csv", "text/csv")
+def find_models(paths):
+    """Returns the .3dm files in the paths, searching directories recursively."""
+    models = []
+    for path in paths:
+        if os.path.isfile(path):
+            models.append(path)
+            continue
+        for folder, _, files in os.walk(path):
+            models.extend(os.path.join(folder, name) for name in files if name.lower().endswith('.3dm'))
+    return models
+
 
+def _to_excel_value(value):
+    """Converts a value to one an Excel cell can hold: no timezones, no NaN, no lists."""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    if pd.isna(value):
+        return None
+    if isinstance(value, datetime):
+        # Excel cannot store timezone-aware datetimes, such as the Firestore `time` timestamps
+        return value.replace(tzinfo=None)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
 
-def export_to_excel(df, filename):
-    """Exports the data to an Excel file."""
+
+def build_csv(df):
+    """Serializes the data to CSV and returns the bytes."""
+    return df.to_csv(index=False).encode()
+
+
+def build_excel(df):
+    """Serializes the data to an Excel workbook with a write-only sheet and returns the bytes."""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(df.columns.tolist())
+    for row in df.itertuples(index=False, name=None):
+        sheet.append([_to_excel_value(value) for value in row])
     buffer = io.BytesIO()
-    df.to_excel(buffer, index=False, header=True, engine='openpyxl')
-    buffer.seek(0)  # reset pointer
+    workbook.save(buffer)
+    return buffer.getvalue()
+
 
-    st.download_button("💹Download Excel", buffer, f"{filename}.xlsx",
-                       'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+def build_parquet(table):
+    """Serializes an Arrow table to Parquet and returns the bytes, so readers can load only the columns they need."""
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
 
 
-def compress_to_xz(file):
-    """Compresses the file to a xz file using lzma compression. This is smaller but slower than gzip."""
-    _create_temp_dir()
-    compressed_filename = file.name + '.xz'
-    with lzma.open(f'temp/{compressed_filename}', 'wb') as f_out:
-        f_out.write(file.getvalue())
-    return f'temp/{compressed_filename}'
+def build_feather(table):
+    """Serializes an Arrow table to an Arrow IPC (Feather v2) file and returns the bytes."""
+    buffer = io.BytesIO()
+    feather.write_feather(table, buffer, compression='zstd')
+    return buffer.getvalue()
 
 
-def compress_to_gzip(file):
-    """Compresses the file to a gzip file. This is faster but larger than xz. This is the default compression method."""
-    _create_temp_dir()
-    compressed_filename = file.name + '.gz'
-    with gzip.open(f'temp/{compressed_filename}', 'wb') as f_out:
-        f_out.write(file.getvalue())
-    return f'temp/{compressed_filename}'
+def _json_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def build_ndjson(table):
+    """Serializes an Arrow table to newline-delimited JSON, one item per line, and returns the bytes."""
+    lines = []
+    for batch in table.to_batches():
+        lines.extend(json.dumps(row, default=_json_default) for row in batch.to_pylist())
+    return ('\n'.join(lines) + '\n').encode() if lines else b''
+
+
+def build_model_manifest(table):
+    """Lists the 3D models of an Arrow table of items as JSON, with the url, md5 and size of each."""
+    models = []
+    for item in table.select([column for column in MANIFEST_COLUMNS if column in table.column_names]).to_pylist():
+        md5_hashes = item.get('md5_hash') or []
+        sizes = item.get('model_size') or []
+        for n, url in enumerate(item.get('3d_model') or []):
+            models.append({
+                'uid': item.get('uid'),
+                'student_number': item.get('student_number'),
+                'url': url,
+                'md5_hash': md5_hashes[n] if n < len(md5_hashes) else None,
+                'size': sizes[n] if n < len(sizes) else None
+            })
+    return json.dumps(models, separators=(',', ':')).encode()
+
+
+# export formats: how the data is serialized, its extension and mime type, and the label of its download button.
+# Flat formats are built from the inventory frame with its lists exploded into columns, nested ones from an Arrow
+# table of the items that keeps the lists
+EXPORT_FORMATS = {
+    'csv': {'build': build_csv, 'name': 'CSV', 'extension': 'csv', 'mime': 'text/csv', 'label': '📃Download CSV'},
+    'excel': {'build': build_excel, 'name': 'Excel', 'extension': 'xlsx', 'label': '💹Download Excel',
+              'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    'parquet': {'build': build_parquet, 'nested': True, 'name': 'Parquet', 'extension': 'parquet',
+                'mime': 'application/vnd.apache.parquet', 'label': '🧱Download Parquet'},
+    'feather': {'build': build_feather, 'nested': True, 'name': 'Feather', 'extension': 'arrow',
+                'mime': 'application/vnd.apache.arrow.file', 'label': '🏹Download Feather'},
+    'ndjson': {'build': build_ndjson, 'nested': True, 'name': 'NDJSON', 'extension': 'ndjson',
+               'mime': 'application/x-ndjson', 'label': '🧾Download NDJSON'},
+    'manifest': {'build': build_model_manifest, 'nested': True, 'name': 'Model Manifest', 'extension': 'json',
+                 'mime': 'application/json', 'label': '📋Download Model Manifest'}
+}
+
+
+def iter_compress(file, digests, compress='gzip', level=None, dictionary=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Compresses the file one chunk at a time and yields the compressed data, filling in `digests`."""
+    compressor = STREAM_COMPRESSORS[compress](level, dictionary)
+    original_md5 = hashlib.md5()
+    compressed_md5 = hashlib.md5()
+    digests['original_size'] = 0
+    digests['size'] = 0
+
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            data = compressor.flush()
+        else:
+            original_md5.update(chunk)
+            digests['original_size'] += len(chunk)
+            data = compressor.compress(chunk)
+        if data:
+            compressed_md5.update(data)
+            digests['size'] += len(data)
+            yield data
+        if not chunk:
+            break
+
+    digests['md5_hash'] = compressed_md5.hexdigest()
+    digests['original_md5'] = original_md5.hexdigest()
+
+
+def get_compression(path):
+    """Returns the compression of a file from its extension, or None if it is not compressed."""
+    for compress, extension in COMPRESSED_EXTENSIONS.items():
+        if path.endswith(extension):
+            return compress
+    return None
+
+
+def get_zstd_dictionary_id(file):
+    """Returns the id of the dictionary a zstd file was compressed with, read from its frame header, or 0 if none."""
+    position = file.tell()
+    # a zstd frame header is at most 18 bytes
+    header = file.read(18)
+    file.seek(position)
+    return zstandard.get_frame_parameters(header).dict_id
+
+
+def iter_decompress(file, compress, dictionary=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Decompresses the file one chunk at a time and yields the original data."""
+    decompressor = STREAM_DECOMPRESSORS[compress](dictionary)
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    # lzma has nothing left to flush
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
 
 # def export_to_json(df, filename):
 #     """Exports the data to a json file."""
@@ -93,6 +337,7 @@ def compress_to_gzip(file):
 #         st.error('Failed to export to JSON.')
 #         st.stop()
 
+
 def process_uploaded_image(uploaded_image):
     """Process the uploaded image: compress and generate metadata."""
     import io
@@ -0,0 +1,117 @@
+import bisect
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import streamlit as st
+
+# country -> state -> city index built from the CSVs in data/ by scripts/build_location_index.py
+LOCATION_INDEX_PATH = 'data/locations.arrow'
+# bumped whenever the layout of the index changes, the build script stamps it in the file
+LOCATION_INDEX_FORMAT = '1'
+# maximum number of matches a prefix search returns
+SEARCH_LIMIT = 50
+
+
+def build_table(places):
+    """Builds the sorted index table from (country, state, city) rows."""
+    places = sorted(set(places), key=lambda place: tuple('' if name is None else name for name in place))
+    columns = {}
+    for position, column in enumerate(['country', 'state']):
+        values = [place[position] for place in places]
+        dictionary = sorted({value for value in values if value is not None})
+        codes = {value: code for code, value in enumerate(dictionary)}
+        # a missing name sorts first, as -1
+        indices = pa.array([codes.get(value, -1) for value in values], pa.int32())
+        columns[column] = pa.DictionaryArray.from_arrays(pc.if_else(pc.equal(indices, -1), None, indices),
+                                                          pa.array(dictionary, pa.string()))
+    columns['city'] = pa.array([place[2] for place in places], pa.string())
+    return pa.table(columns).replace_schema_metadata({'format': LOCATION_INDEX_FORMAT})
+
+
+def write_index(table, path=LOCATION_INDEX_PATH):
+    """Writes the index as an uncompressed Arrow IPC file in a single batch, so it can be memory-mapped."""
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+
+
+def _codes(column):
+    """Returns the dictionary codes of a column, missing names as -1, with its names."""
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    return array.indices.fill_null(-1).to_numpy(), array.dictionary.to_pylist()
+
+
+def load_index(path=LOCATION_INDEX_PATH):
+    """Memory-maps the index."""
+    source = pa.memory_map(path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    metadata = table.schema.metadata or {}
+    if metadata.get(b'format') != LOCATION_INDEX_FORMAT.encode():
+        raise ValueError(f'{path} is not a version {LOCATION_INDEX_FORMAT} location index, '
+                         f'rebuild it with scripts/build_location_index.py')
+    country_codes, countries = _codes(table['country'])
+    state_codes, states = _codes(table['state'])
+    return {
+        'source': source,
+        'countries': countries,
+        'country_codes': country_codes,
+        'states': states,
+        'state_codes': state_codes,
+        'cities': table['city']
+    }
+
+
+@st.cache_resource
+def get_index(path=LOCATION_INDEX_PATH):
+    """Returns the location index, loaded once per process and shared across sessions."""
+    return load_index(path)
+
+
+def _range(codes, names, name, start=0, end=None):
+    """Returns the rows [start, end) holding the name, within rows [start, end) sorted by code."""
+    end = len(codes) if end is None else end
+    position = bisect.bisect_left(names, name)
+    if position == len(names) or names[position] != name:
+        return start, start
+    section = codes[start:end]
+    return (start + int(np.searchsorted(section, position, 'left')),
+            start + int(np.searchsorted(section, position, 'right')))
+
+
+def _scope(index, country=None, state=None):
+    """Returns the rows of the country, and of the state within it, or all rows."""
+    if country is None:
+        return 0, len(index['country_codes'])
+    start, end = _range(index['country_codes'], index['countries'], country)
+    if state is not None:
+        start, end = _range(index['state_codes'], index['states'], state, start, end)
+    return start, end
+
+
+def _distinct(codes, names):
+    return [names[code] for code in np.unique(codes) if code >= 0]
+
+
+def get_countries(index):
+    """Returns the countries, sorted."""
+    return list(index['countries'])
+
+
+def get_states(index, country):
+    """Returns the states of the country, sorted."""
+    start, end = _scope(index, country)
+    return _distinct(index['state_codes'][start:end], index['states'])
+
+
+def get_cities(index, country, state):
+    """Returns the cities of the state of the country, sorted."""
+    start, end = _scope(index, country, state)
+    return [city for city in index['cities'][start:end].to_pylist() if city is not None]
+
+
+def search_cities(index, prefix, country=None, state=None, limit=SEARCH_LIMIT):
+    """Returns the cities starting with the prefix, case insensitive, within the country and state if given."""
+    start, end = _scope(index, country, state)
+    cities = index['cities'][start:end]
+    matches = cities.filter(pc.fill_null(pc.starts_with(cities, pattern=prefix, ignore_case=True), False))
+    return matches[:limit].to_pylist()
@@ -1,13 +1,11 @@
 import streamlit as st
 import sidebar
-import io
-from backend import db_handler, gcp_handler
+from backend import db_handler, gcp_handler, job_queue
 import utils
-import file_io
-from PIL import Image
 import traceback
 import streamlit_toggle as toggle
 import pd_table
+import locations
 import map
 from streamlit_extras.no_default_selectbox import selectbox
 
@@ -23,6 +21,12 @@ utils.initialize_session_state()
 
 APP_NAME = st.session_state['app_name']
 ROOT = st.session_state['db_root']
+# number of recent submission jobs listed under the form
+JOBS_SHOWN = 5
+# countries offered by the source and origin pickers
+LOCATION_COUNTRIES = ['Australia', 'China', 'United States', 'United Kingdom', 'Japan', 'Germany', 'France', 'Italy']
+# states with more cities than this are searched by the start of the city name instead of listed
+CITY_OPTIONS_LIMIT = 500
 
 # set up containers
 app_header = st.container()
@@ -47,7 +51,7 @@ def submit_form(base_info, source_info, origin_info, uploaded_images, uploaded_m
 
     st.session_state['msg'] = ''
     filename = f'{spec_id}-{name}-{st.session_state["student_number"]}'
-    with st.spinner(text='Uploading data...'):
+    with st.spinner(text='Queuing data...'):
         try:
             if len(uploaded_images) > 10:
                 st.error('❌Maximum 10 images allowed.')
@@ -58,125 +62,88 @@ def submit_form(base_info, source_info, origin_info, uploaded_images, uploaded_m
             elif amount == 0:
                 st.error('❌Count cannot be `0`.')
                 st.stop()
+            elif uid in gcp_handler.RESERVED_UIDS:
+                st.error(f'❌UID `{uid}` is reserved, please use another one.')
+                st.stop()
             else:
+                data = {
+                    'spec_id': spec_id,
+                    'name': name,
+                    'material': material,
+                    'amount': amount,
+                    'unit': unit,
+                    'notes': notes,
+                    'model_scale': model_scale,
+                    'source_name': source_info['name'],
+                    'source_year': source_info['year'],
+                    'source_latitude': source_info['latitude'],
+                    'source_longitude': source_info['longitude'],
+                    'source_country': source_info['country'],
+                    'source_state': source_info['state'],
+                    'source_city': source_info['city'],
+                    'source_notes': source_info['notes'],
+                    'origin_name': origin_info['name'],
+                    'origin_year': origin_info['year'],
+                    'origin_latitude': origin_info['latitude'],
+                    'origin_longitude': origin_info['longitude'],
+                    'origin_country': origin_info['country'],
+                    'origin_state': origin_info['state'],
+                    'origin_city': origin_info['city'],
+                    'origin_notes': origin_info['notes'],
+                    'owner': st.session_state['student_number']
+                }
+                payload = {'root': ROOT, 'uid': uid, 'filename': filename, 'data': data}
+                # the images and the 3D model are copied to the queue, the worker uploads them and writes the item.
+                # With locked assets only the fields are updated
+                files = {'images': [], 'model': []}
                 if not st.session_state['lock_assets']:
-                    # upload images
-                    img_count = 0
-                    for uploaded_image in uploaded_images:
-                        # Convert to webp to reduce file size
-                        img_data = uploaded_image.read()
-                        img = Image.open(io.BytesIO(img_data))
-                        file_path = file_io.compress_image(img, quality=90, format='webp')
-
-                        # create metadata
-                        img_meta = {
-                            'category': 'image',
-                            'original_name': uploaded_image.name,
-                            'original_size': utils.calculate_size(img_data),
-                            'original_md5': utils.calculate_md5(img_data)
-                        }
-
-                        with open(file_path, 'rb') as f:
-                            gcp_handler.upload_to_bucket(ROOT, f, uid, f'{filename}-{img_count:02d}', metadata=img_meta)
-                        img_count += 1
-
-                    # upload 3D model
-                    model_data = uploaded_model.read()
-                    model_meta = {
-                        'category': '3d_model',
-                        'original_name': uploaded_model.name,
-                        'original_size': utils.calculate_size(model_data),
-                        'original_md5': utils.calculate_md5(model_data)
-                    }
-                    uploaded_model.seek(0)  # reset pointer
-                    gcp_handler.upload_to_bucket(ROOT, uploaded_model, uid, filename, compress='gzip',
-                                                 metadata=model_meta)
-
-                    # upload metadata to database
-                    data = {
-                        'spec_id': spec_id,
-                        'name': name,
-                        'material': material,
-                        'amount': amount,
-                        'unit': unit,
-                        'notes': notes,
-                        'images': gcp_handler.get_blob_info(ROOT, uid, f'{filename}*',
-                                                            ['.jpg', '.jpeg', '.png', '.webp'],
-                                                            infos=['url']),
-                        '3d_model': gcp_handler.get_blob_info(ROOT, uid, f'{filename}*', ['.obj', '.3dm', '.gz', '.xz'],
-                                                              infos=['url']),
-                        'original_md5': gcp_handler.get_blob_info(ROOT, uid, f'{filename}*',
-                                                                  ['.obj', '.3dm', '.gz', '.xz'],
-                                                                  infos=['original_md5']),
-                        'md5_hash': gcp_handler.get_blob_info(ROOT, uid, f'{filename}*',
-                                                              ['.obj', '.3dm', '.gz', '.xz'],
-                                                              infos=['md5_hash']),
-                        'time': utils.get_current_time(),
-                        'model_scale': model_scale,
-                        'source_name': source_info['name'],
-                        'source_year': source_info['year'],
-                        'source_latitude': source_info['latitude'],
-                        'source_longitude': source_info['longitude'],
-                        'source_country': source_info['country'],
-                        'source_state': source_info['state'],
-                        'source_city': source_info['city'],
-                        'source_notes': source_info['notes'],
-                        'origin_name': origin_info['name'],
-                        'origin_year': origin_info['year'],
-                        'origin_latitude': origin_info['latitude'],
-                        'origin_longitude': origin_info['longitude'],
-                        'origin_country': origin_info['country'],
-                        'origin_state': origin_info['state'],
-                        'origin_city': origin_info['city'],
-                        'origin_notes': origin_info['notes'],
-                        'owner': st.session_state['student_number']
-                    }
-                    db_handler.set_data(data, uid)
-                else:
-                    data = {
-                        'spec_id': spec_id,
-                        'name': name,
-                        'material': material,
-                        'amount': amount,
-                        'unit': unit,
-                        'notes': notes,
-                        'time': utils.get_current_time(),
-                        'model_scale': model_scale,
-                        'source_name': source_info['name'],
-                        'source_year': source_info['year'],
-                        'source_latitude': source_info['latitude'],
-                        'source_longitude': source_info['longitude'],
-                        'source_country': source_info['country'],
-                        'source_state': source_info['state'],
-                        'source_city': source_info['city'],
-                        'source_notes': source_info['notes'],
-                        'origin_name': origin_info['name'],
-                        'origin_year': origin_info['year'],
-                        'origin_latitude': origin_info['latitude'],
-                        'origin_longitude': origin_info['longitude'],
-                        'origin_country': origin_info['country'],
-                        'origin_state': origin_info['state'],
-                        'origin_city': origin_info['city'],
-                        'origin_notes': origin_info['notes'],
-                        'owner': st.session_state['student_number']
-                    }
-                    db_handler.update_data(data, uid, st.session_state['student_number'])
-
-                # clear cache
-                st.cache_data.clear()
+                    files = {'images': uploaded_images, 'model': [uploaded_model]}
+                job_id = job_queue.enqueue('submit', st.session_state['student_number'], payload, files)
+                job_queue.ensure_worker()
 
                 if not st.session_state['lock_uid']:
                     st.session_state['uid'] = utils.create_uuid()
-                    st.session_state['msg'] = '🚀Data submitted to database! New UID generated.'
+                    st.session_state['msg'] = f'🚀Data queued as job `{job_id}`! New UID generated.'
                 else:
-                    st.session_state['msg'] = '🚀Data submitted to database! UID is kept the same.'
+                    st.session_state['msg'] = f'🚀Data queued as job `{job_id}`! UID is kept the same.'
                 st.experimental_rerun()
         except Exception as e:
             tb = traceback.format_exc()
-            st.error(f"❌Error uploading data to database. **\n\n{e}**\n\n**Traceback**:\n ```{tb}```")
+            st.error(f"❌Error queuing data. **\n\n{e}**\n\n**Traceback**:\n ```{tb}```")
             st.stop()
 
 
+def jobs_form():
+    """Lists the latest submissions of the user with their progress, and retries the failed ones."""
+    jobs = job_queue.list_jobs(st.session_state['student_number'], limit=JOBS_SHOWN)
+    if not jobs:
+        return
+    # the worker writes the items from another process, pull the ones finished since the last sync into the snapshot.
+    # A snapshot not loaded yet is left to get_data, which restores it from disk first
+    synced_at = db_handler.get_snapshot()['synced_at']
+    if synced_at is not None and any(job['status'] == 'done' and job['updated'] > synced_at.timestamp()
+                                     for job in jobs):
+        db_handler.refresh_snapshot(st.session_state['db'])
+    # a crashed worker leaves its job running, a new one reclaims the job once it has gone stale
+    if any(job_queue.is_stalled(job) for job in jobs):
+        job_queue.ensure_worker()
+    with st.expander('📦 Submissions', expanded=any(job['status'] != 'done' for job in jobs)):
+        if st.button('🔃 Refresh', key='refresh_jobs'):
+            st.experimental_rerun()
+        for job in jobs:
+            uid = job['payload']['uid']
+            if job['status'] == 'done':
+                st.success(f"✅ `{job['id']}`: {uid} submitted.")
+            elif job['status'] == 'failed':
+                st.error(f"❌ `{job['id']}`: {uid} failed after {job['attempts']} attempt(s). **{job['error']}**")
+                if st.button('🔁 Retry', key=f"retry_{job['id']}"):
+                    job_queue.retry_job(job['id'])
+                    job_queue.ensure_worker()
+                    st.experimental_rerun()
+            else:
+                st.info(f"⏳ `{job['id']}`: {uid} {job['status']}. {job['progress']}")
+
+
 def db_selector_form():
     """Quick Edit Form"""
     with st.expander("📝 Modify from database"):
@@ -245,20 +212,50 @@ def map_marker_form():
     map.make_map_responsive()
 
 
-def advanced_info_form():
-    target_countries = ['Australia', 'China', 'United States', 'United Kingdom', 'Japan', 'Germany', 'France', 'Italy']
-
-    states_df = file_io.read_csv('data/states.csv')
-    cities_df = file_io.read_csv('data/cities.csv')
-
-    # Filter the dataframes based on the desired countries
-    filtered_states_df = states_df[states_df['country_name'].isin(target_countries)]
-    filtered_cities_df = cities_df[cities_df['country_name'].isin(target_countries)]
-
-    countries_list = target_countries
-    states_list = list(set(filtered_states_df['name'].tolist()))
-    cities_list = list(set(filtered_cities_df['name'].tolist()))
-
+def location_picker(label, key, default=(None, None, None), optional=False):
+    """Cascaded country, state and city pickers over the location index. Returns (country, state, city)."""
+    index = locations.get_index()
+
+    def pick(name, options, default_value):
+        if optional:
+            return selectbox(f'{label} {name}', options, no_selection_label="<Unknown>", key=f'{key}_{name.lower()}')
+        return st.selectbox(f'{label} {name}', options, index=utils.index_of_list(options, default_value),
+                            key=f'{key}_{name.lower()}')
+
+    col1, col2, col3 = st.columns([1, 1, 1])
+    with col1:
+        country = pick('Country', LOCATION_COUNTRIES, default[0])
+    with col2:
+        state = pick('State', locations.get_states(index, country) if country else [], default[1])
+    with col3:
+        cities = locations.get_cities(index, country, state) if state else []
+        if len(cities) > CITY_OPTIONS_LIMIT:
+            # too many to list, narrow them down by the start of the name
+            prefix = st.text_input(f'{label} City starts with', key=f'{key}_city_prefix')
+            cities = locations.search_cities(index, prefix, country, state, limit=CITY_OPTIONS_LIMIT) if prefix \
+                else cities[:CITY_OPTIONS_LIMIT]
+        if cities or not state:
+            city = pick('City', cities, default[2])
+        else:
+            # the index holds no cities for the state
+            city = st.text_input(f'{label} City', value=default[2] or '', key=f'{key}_city_name')
+    return country, state, city
+
+
+def location_form():
+    """The source and origin location pickers. Returns the (country, state, city) of each."""
+    with st.expander('📍 Locations', expanded=False):
+        col_a, col_b = st.columns(2)
+        with col_a:
+            st.markdown("### 🏗️ Source")
+            source_location = location_picker('Source', 'source', ('Australia', 'Victoria', 'Melbourne'))
+        with col_b:
+            st.markdown('### 🏭 Origin')
+            origin_location = location_picker('Origin', 'origin', optional=True)
+    return source_location, origin_location
+
+
+def advanced_info_form(source_location, origin_location):
     col_a, col_b = st.columns(2)
     with col_a:
         st.markdown("### 🏗️ Source")
@@ -281,14 +278,7 @@ def advanced_info_form():
                                                help='Longitude of the source location',
                                                min_value=-180.0, max_value=180.0, value=0.0)
 
-        col1, col2, col3 = st.columns([1, 1, 1])
-        with col1:
-            source_country = st.selectbox('Source Country', countries_list,
-                                          index=utils.index_of_list(countries_list, 'Australia'))
-        with col2:
-            source_state = st.selectbox('Source State', states_list, index=utils.index_of_list(states_list, 'Victoria'))
-        with col3:
-            source_city = st.selectbox('Source City', cities_list, index=utils.index_of_list(cities_list, 'Melbourne'))
+        source_country, source_state, source_city = source_location
         source_notes = st.text_area('Source Notes (e.g. `shed-a` or `toilet`)', height=130,
                                     help='Notes or description for extra info')
     with col_b:
@@ -311,14 +301,7 @@ def advanced_info_form():
                                                help='Longitude of the origin location',
                                                min_value=-180.0, max_value=180.0, value=0.0)
 
-        col1, col2, col3 = st.columns([1, 1, 1])
-        with col1:
-            origin_country = selectbox('Origin Country', countries_list, no_selection_label="<Unknown>")
-        with col2:
-            origin_state = selectbox('Origin State', states_list, no_selection_label="<Unknown>")
-        with col3:
-            origin_city = selectbox('Origin City', cities_list, no_selection_label="<Unknown>")
-
+        origin_country, origin_state, origin_city = origin_location
         origin_notes = st.text_area('Origin Notes', height=130, help='Notes or description for extra info')
 
     # handle empty values
@@ -389,6 +372,7 @@ def info_form(uid, df):
         amount_default = 0
         unit_default = 0
         notes_default = ''
+    source_location, origin_location = location_form()
     with st.form(key='info_form'):
         col1, col2 = st.columns(2)
         with col1:
@@ -417,7 +401,7 @@ def info_form(uid, df):
                                  value=notes_default)
 
         with st.expander('📝 Advanced Infos', expanded=False):
-            source_info, origin_info = advanced_info_form()
+            source_info, origin_info = advanced_info_form(source_location, origin_location)
             st.markdown('**Map Marker**: Click on the map to get the exact coordinates. '
                         'Copy and paste the coordinates (`latitude`, `longitude`) to the form.')
             map_marker_form()
@@ -452,6 +436,7 @@ def data_form():
     # data form
     if st.session_state['is_authenticated']:
         with app_body:
+            jobs_form()
             df = db_selector_form()
             uid = uid_form()
             info_form(uid, df)
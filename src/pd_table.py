@@ -1,42 +1,73 @@
 import streamlit as st
-from backend import db_handler
+from backend import db_handler, gcp_handler
 import file_io
-import utils
+import search_index
 from streamlit_sortables import sort_items
 from streamlit_extras import stateful_button
+from google.api_core import exceptions
+import json
+import hashlib
 import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# sort keys of the paged mode, '__name__' is the document path: student number, then uid. Every other key needs its
+# single-field index enabled for the Items collection group, see the README
+PAGE_SORT_KEYS = ['__name__', 'time', 'spec_id', 'name', 'material']
+PAGE_SIZES = [25, 50, 100, 250]
+# thumbnails shown in the images columns instead of the full-resolution photos
+TABLE_THUMBNAIL_SIZE = 128
+# fields the nested exports carry on top of the table's
+EXPORT_MODEL_COLUMNS = ['original_md5', 'md5_hash', 'model_size']
+EXPORT_BUTTONS_PER_ROW = 3
+
+
+def _to_native(value):
+    """Converts numpy scalars to native Python types, so they can be written to the database."""
+    return value.item() if isinstance(value, np.generic) else value
 
 
 def compare_dataframes(df_original, df_modified):
     """Compares two DataFrames and returns a list of modified data."""
+    # Align the rows on uid and the columns on the original DataFrame
+    original = df_original.set_index('uid', drop=False)
+    modified = df_modified.set_index('uid', drop=False).reindex(index=original.index, columns=original.columns)
+
+    # Compare whole columns at once, a field is modified unless both values are equal or both are missing
+    both_missing = original.isna() & modified.isna()
+    changed = (original.ne(modified) & ~both_missing).to_numpy(dtype=bool, na_value=True)
+
+    uids = original['uid'].to_numpy()
+    student_numbers = original['student_number'].to_numpy()
+    columns = original.columns
+
     modified_data = []
+    for row in np.flatnonzero(changed.any(axis=1)):
+        # Get the modified fields
+        modified_fields = {columns[col]: _to_native(modified.iat[row, col]) for col in np.flatnonzero(changed[row])}
 
-    # Iterate through each row in the original DataFrame
-    for idx, row in df_original.iterrows():
-        # If the row is not equal to the corresponding row in the modified DataFrame
-        if not row.equals(df_modified.loc[idx]):
-            # Get the modified row
-            modified_row = df_modified.loc[idx]
-            # Get the uid and student_number from the original row
-            uid = row['uid']
-            student_number = row['student_number']
-
-            # Get the modified fields
-            modified_fields = {field: modified_row[field] for field in df_original.columns if
-                               row[field] != modified_row[field]}
-
-            # Append the result
-            modified_data.append({
-                'uid': uid,
-                'student_number': student_number,
-                'modified_fields': modified_fields
-            })
+        # Append the result
+        modified_data.append({
+            'uid': uids[row],
+            'student_number': student_numbers[row],
+            'modified_fields': modified_fields
+        })
 
     return modified_data
 
 
-def search_data(df, filter_dict):
-    """Filters the data in the DataFrame."""
+def search_data(df, filter_dict, index=None):
+    """Filters the data in the DataFrame, through its search index if given."""
+    if index is not None:
+        positions = None
+        for key, filter_value in filter_dict.items():
+            if filter_value == '':
+                continue
+            matched = search_index.lookup(index, key, filter_value)
+            if matched is not None:
+                positions = matched if positions is None else np.intersect1d(positions, matched)
+        return df if positions is None else df.iloc[positions]
+
     # Get the filter keys
     filter_keys = filter_dict.keys()
 
@@ -66,41 +97,47 @@ def search_data(df, filter_dict):
 
 
 def handel_update(filtered_df, modified_df):
+    review_changes(compare_dataframes(filtered_df, modified_df))
+
+
+def review_changes(modified_data):
+    """Shows the modified data and commits it to the database on confirmation."""
     try:
-        modified_data = compare_dataframes(filtered_df, modified_df)
         if len(modified_data) == 0:
             st.warning("⚠️ No changes detected!")
             return
         else:
-            delete_count = 0
-            update_count = 0
-
             st.write(modified_data)
             if st.button("💾 Commit changes"):
                 # set confirm to True
                 st.session_state['commit'] = True
 
-                # check if modified_fields contains delete
+                # split the rows to delete from the rows to update
+                updates = []
+                deletes = []
                 for data in modified_data:
                     if 'delete' in data['modified_fields']:
                         if data['modified_fields']['delete'] == True:
-                            db_handler.delete_data(data['uid'], data['student_number'])
-                            delete_count += 1
+                            deletes.append(data)
                     else:
-                        # add current time to modified_fields
-                        data['modified_fields']['time'] = utils.get_current_time()
-
-                        # check if modified_fields contains numpy.int64
-                        for key, value in data['modified_fields'].items():
-                            if isinstance(value, np.int64):
-                                data['modified_fields'][key] = int(value)
-
-                        db_handler.update_data(data['modified_fields'], data['uid'], data['student_number'])
-                        update_count += 1
-                st.success(
-                    f"✅ Successfully updated ({update_count}) and deleted ({delete_count}) items to database!)")
-                st.cache_data.clear()
-                st.experimental_rerun()
+                        updates.append(data)
+
+                report = db_handler.commit_changes(updates, deletes)
+                update_count = sum(1 for row in report if row['success'] and row['action'] == 'update')
+                delete_count = sum(1 for row in report if row['success'] and row['action'] == 'delete')
+                failed = [row for row in report if not row['success']]
+
+                # drop the pages and edits of the paged mode, they are stale now
+                st.session_state.pop('paging', None)
+                st.session_state['page_edits'] = {}
+                if failed:
+                    st.success(f"✅ Updated ({update_count}) and deleted ({delete_count}) items.")
+                    st.error(f"❌ ({len(failed)}) items could not be committed:")
+                    st.dataframe(failed, use_container_width=True)
+                else:
+                    st.success(
+                        f"✅ Successfully updated ({update_count}) and deleted ({delete_count}) items to database!)")
+                    st.experimental_rerun()
 
     except Exception as e:
         st.error(f"❌ Error: {e}, Could not update database! Try again, or contact the developer.")
@@ -142,28 +179,248 @@ def manage_filter_items(original_df_columns):
 
     return filter_keys
 
+@st.cache_resource
+def get_page_executor():
+    """Returns the thread pool shared by all sessions to fetch and prefetch the pages of the paged table."""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+def get_paging_state(sort_key, page_size):
+    """Returns the session's paging state, starting over from the first page when the sort key or page size changes."""
+    paging = st.session_state.get('paging')
+    if paging is None or paging['key'] != (sort_key, page_size):
+        paging = {'key': (sort_key, page_size), 'page': 0, 'pages': {}}
+        st.session_state['paging'] = paging
+    if 'page_edits' not in st.session_state:
+        st.session_state['page_edits'] = {}
+    return paging
+
+
+def fetch_page(paging, page_number):
+    """Returns the records of a page, waiting for its fetch or prefetch, and starts prefetching the next page."""
+    db = st.session_state['db']
+    sort_key, page_size = paging['key']
+    pages = paging['pages']
+    executor = get_page_executor()
+
+    if page_number not in pages:
+        cursor = pages[page_number - 1].result()[1] if page_number > 0 else None
+        pages[page_number] = executor.submit(db_handler.get_page, db, sort_key, page_size, cursor)
+    try:
+        records, next_cursor = pages[page_number].result()
+    except Exception:
+        # drop the failed fetch so the next rerun tries again
+        del pages[page_number]
+        raise
+
+    if next_cursor is not None and page_number + 1 not in pages:
+        pages[page_number + 1] = executor.submit(db_handler.get_page, db, sort_key, page_size, next_cursor)
+    return records, next_cursor
+
+
+def page_controls():
+    """Creates the sort and navigation controls of the paged table and returns the records of the visible page."""
+    # sort keys Firestore refused for lack of an index in this session
+    unindexed = st.session_state.setdefault('unindexed_sort_keys', set())
+    col1, col2, col3, col4 = st.columns([1, 1, 0.25, 0.25])
+    with col1:
+        sort_key = st.selectbox('Page order', [key for key in PAGE_SORT_KEYS if key not in unindexed],
+                                key='page_sort_key',
+                                format_func=lambda key: 'student number, uid' if key == '__name__' else key,
+                                help='Items without a value for this field are not listed.')
+    with col2:
+        page_size = st.selectbox('Rows per page', PAGE_SIZES, index=1, key='page_size')
+
+    paging = get_paging_state(sort_key, page_size)
+    try:
+        records, next_cursor = fetch_page(paging, paging['page'])
+    except exceptions.FailedPrecondition as e:
+        if sort_key == '__name__':
+            raise
+        # the field's index is not enabled for the Items collection group, fall back to the document path
+        print(f"Cannot order the pages by {sort_key}: {e}")
+        unindexed.add(sort_key)
+        st.session_state.pop('paging', None)
+        st.experimental_rerun()
+    if unindexed:
+        st.caption(f"Ordering by {', '.join(f'`{key}`' for key in sorted(unindexed))} needs its single-field index "
+                   f"enabled for the `Items` collection group, ask an admin to add it.")
+
+    with col3:
+        if st.button('⬅️ Previous', disabled=paging['page'] == 0):
+            paging['page'] -= 1
+            st.experimental_rerun()
+    with col4:
+        if st.button('➡️ Next', disabled=next_cursor is None):
+            paging['page'] += 1
+            st.experimental_rerun()
+    st.caption(f"Page {paging['page'] + 1}, {len(st.session_state['page_edits'])} items edited across pages")
+    return records
+
+
+def apply_page_edits(df):
+    """Applies the edits made to the rows of the page on an earlier visit."""
+    page_edits = st.session_state['page_edits']
+    df = df.copy()
+    for idx, uid in df['uid'].items():
+        for field, value in page_edits.get(uid, {}).get('modified_fields', {}).items():
+            if field in df.columns:
+                df.at[idx, field] = value
+    return df
+
+
+def track_page_edits(original_df, modified_df):
+    """Records the edits of the visible rows and columns of the page, so they reach the commit."""
+    page_edits = st.session_state['page_edits']
+    keys = [col for col in ['uid', 'student_number'] if col not in modified_df.columns]
+    modified_df = modified_df.join(original_df[keys])
+    original_df = original_df[modified_df.columns]
+    changes = {data['uid']: data['modified_fields'] for data in compare_dataframes(original_df, modified_df)}
+    for uid, student_number in zip(original_df['uid'], original_df['student_number']):
+        modified_fields = page_edits.get(uid, {}).get('modified_fields', {})
+        # the visible columns are replaced by this render's diff, edits of hidden columns are kept
+        for field in original_df.columns:
+            modified_fields.pop(field, None)
+        modified_fields.update(changes.get(uid, {}))
+        if modified_fields:
+            page_edits[uid] = {'uid': uid, 'student_number': student_number, 'modified_fields': modified_fields}
+        else:
+            page_edits.pop(uid, None)
+
+
+@st.cache_resource(max_entries=4)
+def build_export(export_format, columns_order, version, _data):
+    """Serializes `_data`, the inventory at the version, to the export format, once per version and format."""
+    spec = file_io.EXPORT_FORMATS[export_format]
+    if spec.get('nested'):
+        # the lists stay nested, alongside the hashes and sizes of the models
+        columns = [col for col in columns_order if col != 'delete'] + EXPORT_MODEL_COLUMNS
+        return spec['build'](db_handler.records_to_arrow(_data, columns))
+    # built here rather than through build_data, whose cache holds the frames of the table
+    df = db_handler.records_to_dataframe(_data, columns_order)
+    df['delete'] = False
+    return spec['build'](df)
+
+
+def get_export(export_format, columns_order, version):
+    """Returns the export of the inventory at the version, or None if a sync has moved the inventory past it."""
+    data = db_handler.get_inventory_data(version)
+    if data is None:
+        return None
+    return build_export(export_format, columns_order, version, data)
+
+
+def export_buttons(columns_order, version, filename='database'):
+    """Creates a download button per export format. An export is only built once the user asks for it."""
+    requested = st.session_state.setdefault('requested_exports', set())
+    columns = st.columns(EXPORT_BUTTONS_PER_ROW)
+    for n, (export_format, spec) in enumerate(file_io.EXPORT_FORMATS.items()):
+        with columns[n % EXPORT_BUTTONS_PER_ROW]:
+            if (export_format, version) in requested:
+                with st.spinner(f"preparing {spec['name']}..."):
+                    data = get_export(export_format, columns_order, version)
+                if data is None:
+                    # prepare it from the new version of the inventory instead
+                    requested.add((export_format, db_handler.get_inventory_version()))
+                    st.experimental_rerun()
+                st.download_button(spec['label'], data, f"{filename}.{spec['extension']}", spec['mime'],
+                                   key=f'download_{export_format}')
+            elif st.button(f"⚙️ Prepare {spec['name']}", key=f'prepare_{export_format}'):
+                requested.add((export_format, version))
+                st.experimental_rerun()
+
+
+def get_bundle_files(bucket, items):
+    """Lists the images and 3D models of the items as (path in the ZIP, blob name) with the skipped urls."""
+    files = []
+    skipped = []
+    for item in items:
+        for url in list(item.get('images') or []) + list(item.get('3d_model') or []):
+            try:
+                blob_name = gcp_handler.get_blob_name_from_url(bucket, url)
+            except ValueError:
+                skipped.append(url)
+                continue
+            files.append((f"{item['student_number']}/{item['uid']}/{blob_name.rsplit('/', 1)[-1]}", blob_name))
+    return files, skipped
+
+
+def bundle_button(uids, get_records):
+    """Bundles the images and 3D models of the filtered rows into a ZIP on request and offers it."""
+    uids = list(uids)
+    if not uids:
+        return
+    if st.button(f'📦 Bundle {len(uids)} items', key='bundle_files'):
+        records = get_records(uids)
+        items = [records[uid] for uid in uids if uid in records]
+        # an item's time changes whenever it is written, so a bundle is only reused while its items are unchanged
+        key = hashlib.md5(json.dumps([[item['uid'], str(item.get('time'))] for item in items]).encode()).hexdigest()
+        bucket = gcp_handler.get_bucket()
+        # the files are only listed once asked for, a table render does not touch the urls
+        files, skipped = get_bundle_files(bucket, items)
+        if skipped:
+            st.warning(f"⚠️ {len(skipped)} files are not in the bucket and are left out of the bundle: "
+                       f"{', '.join(str(url) for url in skipped[:5])}")
+        if not files:
+            st.warning('⚠️ No files to bundle.')
+            return
+        progress = st.progress(0.0)
+        try:
+            path = gcp_handler.get_bundle(bucket, files, key, progress=lambda done, total: progress.progress(
+                done / total, text=f'Bundled {done}/{total} files'))
+        except Exception as e:
+            st.error(f'failed to bundle the files. **{e}**')
+            st.stop()
+        with open(path, 'rb') as f:
+            st.download_button('⬇️ Download Bundle', f, 'bundle.zip', 'application/zip', key='download_bundle')
+
+
+def use_thumbnails(df):
+    """Points the images columns at the thumbnails of the images and drops the thumbnail columns."""
+    prefix = f'thumbnails_{TABLE_THUMBNAIL_SIZE}_'
+    thumbnail_cols = [col for col in df.columns if col.startswith(prefix)]
+    for col in thumbnail_cols:
+        image_col = f"images_{col[len(prefix):]}"
+        if image_col in df.columns:
+            df[image_col] = df[col].where(df[col].notna(), df[image_col])
+    return df.drop(columns=thumbnail_cols)
+
+
 def table(container):
     """Creates the database table."""
     with container:
         if st.button("🔃 Refresh database"):
-            st.cache_data.clear()
+            # pick up changes made by other app instances, the cached frames of unchanged versions stay valid
+            db_handler.refresh_snapshot(st.session_state['db'])
+            st.session_state.pop('paging', None)
             st.experimental_rerun()
 
+        paged = st.checkbox('📄 Paged mode', key='paged_mode',
+                            help='Only fetch and show one page of the database at a time. '
+                                 'Checking if a UID exists only looks at the visible page.')
+
         with st.spinner("fetching from database..."):
             # fetch data from database
-            order_by = ['delete', 'student_number', 'spec_id', 'name', 'uid', 'material', 'amount', 'unit', 'notes',
-                        'source_name', 'source_notes', 'source_year', 'source_latitude', 'source_longitude',
-                        'source_country', 'source_state', 'source_city',
-                        'origin_name', 'origin_notes', 'origin_year', 'origin_latitude', 'origin_longitude',
-                        'origin_country', 'origin_state', 'origin_city',
-                        'images', '3d_model', 'time', 'model_scale']
-            original_df = db_handler.get_data(order_by)
-            original_df['delete'] = False
+            order_by = list(db_handler.TABLE_COLUMNS)
+            order_by.insert(order_by.index('images') + 1, f'thumbnails_{TABLE_THUMBNAIL_SIZE}')
+            if paged:
+                records = page_controls()
+                if not records:
+                    st.info('ℹ️ No items on this page.')
+                    return pd.DataFrame(columns=['uid'])
+                original_df = use_thumbnails(db_handler.records_to_dataframe(records, order_by))
+                original_df['delete'] = False
+                # show the edits made on an earlier visit of this page
+                display_df = apply_page_edits(original_df)
+            else:
+                original_df = use_thumbnails(db_handler.get_data(order_by))
+                original_df['delete'] = False
+                display_df = original_df
 
         filter_keys = manage_filter_items(original_df.columns.tolist())
 
-        # Create a filter bar
-        filtered_df = original_df.copy()[filter_keys[0]['items']]
+        # Create a filter bar, the columns of a page depend on how many images its items have
+        filtered_df = display_df.copy()[[col for col in filter_keys[0]['items'] if col in display_df.columns]]
 
         # Create a container for the search bar
         col1, col2 = st.columns(2)
@@ -172,8 +429,12 @@ def table(container):
         with col2:
             search_val = st.text_input("Search value", key='Search_value')
 
-        # Filter the data for editing
-        result_df = search_data(filtered_df.copy(), {search_key: search_val})
+        # Filter the data for editing, using the search index of this inventory version
+        if paged:
+            result_df = search_data(filtered_df.copy(), {search_key: search_val})
+        else:
+            index = search_index.get_index(original_df, original_df.attrs.get('version'))
+            result_df = search_data(filtered_df.copy(), {search_key: search_val}, index)
 
         # Get list of column names
         df_cols = filtered_df.columns.tolist()
@@ -249,7 +510,12 @@ def table(container):
             column_config=column_config,
             use_container_width=True,
             disabled=['uid', 'student_number', 'time'],
+            # each page gets its own editor state
+            key=f"page_editor_{st.session_state['paging']['key']}_{st.session_state['paging']['page']}"
+            if paged else None
         )
+        if paged:
+            track_page_edits(original_df.loc[result_df.index], modified_df)
 
         col1, col2 = st.columns([0.2, 1])
         with col1:
@@ -265,13 +531,20 @@ def table(container):
             if stateful_button.button('🔍 Review Changes', key='review'):
                 st.session_state['review'] = True
         if st.session_state['review']:
-            handel_update(result_df, modified_df)
+            if paged:
+                review_changes(list(st.session_state['page_edits'].values()))
+            else:
+                handel_update(result_df, modified_df)
 
         with col2:
-            col3, col4 = st.columns([0.2, 1])
-            with col3:
-                file_io.export_to_csv(original_df, 'database')
-            with col4:
-                file_io.export_to_excel(original_df, "database")
+            if paged:
+                st.caption('Exports are available outside of paged mode.')
+                bundle_button(original_df.loc[result_df.index, 'uid'],
+                              lambda uids: {record['uid']: record for record in records})
+            else:
+                # exports hold the original images, not the thumbnails the table shows
+                export_buttons([col for col in order_by if not col.startswith('thumbnails_')],
+                               original_df.attrs.get('version'))
+                bundle_button(original_df.loc[result_df.index, 'uid'], db_handler.get_records)
 
         return original_df
@@ -0,0 +1,99 @@
+"""One-off backfill: makes the thumbnails of the images of items uploaded before thumbnails were made on upload,
+and records their urls in the items (`thumbnails_128`, `thumbnails_512`), so the inventory table shows them.
+The items keep their `time`, so delta syncs do not see the change: once done, the script requests a full reload,
+which every running app instance makes on its next sync.
+
+Run from the repository root so the streamlit secrets are found:
+    python src/scripts/backfill_thumbnails.py --dry-run
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_admin import firestore
+from backend import db_handler, gcp_handler
+import file_io
+
+
+def make_thumbnails(db, bucket, root, url, owner):
+    """Makes the thumbnails of the image behind the url, points the image at them and returns their urls."""
+    name = gcp_handler.get_blob_name_from_url(bucket, url)
+    folder, filename = name[len(root) + 1:].rsplit('/', 1)
+    stem = os.path.splitext(filename)[0]
+    img_data = bucket.blob(name).download_as_bytes()
+    thumbnails = file_io.get_image_pool().submit(file_io.encode_thumbnails, img_data, filename).result()
+    urls = gcp_handler.upload_thumbnails(bucket, root, thumbnails, folder, stem, owner)
+
+    # later items reusing the image read the thumbnails from its metadata
+    blob = bucket.blob(name)
+    blob.metadata = urls
+    blob.patch()
+    if folder == gcp_handler.CAS_DIR:
+        db.collection('Assets').document(filename).update({f'metadata.{key}': url for key, url in urls.items()})
+    return urls
+
+
+def backfill_item(db, bucket, root, item_doc):
+    """Makes the thumbnails of every image of the item and records them in the item. Returns the number of images."""
+    item = item_doc.to_dict()
+    student_number = item_doc.reference.parent.parent.id
+    images = item.get('images', [])
+    urls = [make_thumbnails(db, bucket, root, url, student_number) for url in images]
+    # a plain update, the time of an item is when it was submitted or edited
+    item_doc.reference.update({f'thumbnails_{size}': [image_urls[f'thumbnail_{size}'] for image_urls in urls]
+                               for size in file_io.THUMBNAIL_SIZES})
+    return len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--root', default='Inventory', help='root folder of the items in the bucket')
+    parser.add_argument('--force', action='store_true', help='also remake the thumbnails of items that have them')
+    parser.add_argument('--workers', type=int, default=8, help='number of items backfilled at once')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be backfilled')
+    parser.add_argument('--app-name', default='backfill', help='name of the firebase app to initialize')
+    args = parser.parse_args()
+
+    db = firestore.client(app=db_handler.get_init_firestore_app(args.app_name))
+    gcp_handler.init()
+    bucket = gcp_handler.get_bucket()
+    fields = [f'thumbnails_{size}' for size in file_io.THUMBNAIL_SIZES]
+
+    pending = []
+    skipped = 0
+    for item_doc in db_handler.iter_items(db):
+        item = item_doc.to_dict()
+        if not item.get('images') or (not args.force and all(field in item for field in fields)):
+            skipped += 1
+            continue
+        pending.append(item_doc)
+    print(f"{len(pending)} items to backfill, {skipped} skipped.")
+    if args.dry_run:
+        db_handler.close_app_if_exists(args.app_name)
+        return
+
+    failed = 0
+    images = 0
+    # downloads and uploads overlap across items, the images are encoded in the image pool
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(backfill_item, db, bucket, args.root, item_doc): item_doc for item_doc in pending}
+        for future, item_doc in futures.items():
+            try:
+                images += future.result()
+                print(f"{item_doc.reference.path}: done")
+            except Exception as e:
+                failed += 1
+                print(f"{item_doc.reference.path}: failed, {e}")
+
+    print(f"Made the thumbnails of {images} images in {len(pending) - failed} items, {failed} failed.")
+    if len(pending) > failed:
+        db_handler.request_full_sync(db)
+        print("Requested a full reload of the inventory from the running app instances.")
+    db_handler.close_app_if_exists(args.app_name)
+
+
+if __name__ == '__main__':
+    main()
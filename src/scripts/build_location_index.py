@@ -0,0 +1,59 @@
+"""Builds the country -> state -> city location index the source and origin pickers read, data/locations.arrow,
+from the countries, states and cities CSVs of the countries-states-cities database. Rebuild it whenever the CSVs
+change; data/cities.csv is optional, without it the index only holds countries and states.
+
+Run from the repository root:
+    python src/scripts/build_location_index.py --countries Australia "United States"
+"""
+import argparse
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import locations
+
+
+def read_rows(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--countries-csv', default='data/countries.csv', help='countries, with a `name` column')
+    parser.add_argument('--states-csv', default='data/states.csv', help='states, with `name` and `country_name`')
+    parser.add_argument('--cities-csv', default='data/cities.csv',
+                        help='cities, with `name`, `state_name` and `country_name`')
+    parser.add_argument('--countries', nargs='*', default=None, help='only index these countries (default: all)')
+    parser.add_argument('--output', default=locations.LOCATION_INDEX_PATH, help='file the index is written to')
+    args = parser.parse_args()
+
+    keep = set(args.countries) if args.countries else None
+    places = []
+    countries = [row['name'] for row in read_rows(args.countries_csv)]
+    states = [(row['country_name'], row['name']) for row in read_rows(args.states_csv)]
+    if os.path.exists(args.cities_csv):
+        cities = [(row['country_name'], row['state_name'], row['name']) for row in read_rows(args.cities_csv)]
+    else:
+        print(f"{args.cities_csv} not found, the index will hold no cities.")
+        cities = []
+
+    # every country and state gets a row of its own, so the ones without states or cities are still listed
+    countries_with_states = {country for country, _ in states}
+    places += [(country, None, None) for country in countries if country not in countries_with_states]
+    places += [(country, state, None) for country, state in states]
+    places += cities
+    if keep is not None:
+        places = [place for place in places if place[0] in keep]
+
+    table = locations.build_table(places)
+    locations.write_index(table, args.output)
+    print(f"Wrote {table.num_rows} places, {len(set(place[0] for place in places))} countries, "
+          f"{sum(place[2] is not None for place in places)} cities to {args.output} "
+          f"({os.path.getsize(args.output) / 1024:.0f}KB).")
+
+
+if __name__ == '__main__':
+    main()
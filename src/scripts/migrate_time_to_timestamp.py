@@ -0,0 +1,71 @@
+"""One-off migration: rewrites the `time` field of every item from a "%Y-%m-%d %H:%M:%S" string to a native
+Firestore timestamp, so delta syncs can query items with an indexed range on `time`.
+
+Run from the repository root so the streamlit secrets are found:
+    python src/scripts/migrate_time_to_timestamp.py --tz Australia/Melbourne --dry-run
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_admin import firestore
+from backend import db_handler
+
+LEGACY_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_legacy_time(value, tz):
+    """Parses a time string written by utils.get_current_time, which used the server's local time."""
+    return datetime.strptime(value, LEGACY_TIME_FORMAT).replace(tzinfo=tz)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tz', default=None,
+                        help='IANA timezone the legacy strings were written in (default: local timezone)')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be migrated')
+    parser.add_argument('--app-name', default='migration', help='name of the firebase app to initialize')
+    args = parser.parse_args()
+
+    tz = ZoneInfo(args.tz) if args.tz else datetime.now().astimezone().tzinfo
+    db = firestore.client(app=db_handler.get_init_firestore_app(args.app_name))
+
+    batch = db.batch()
+    pending = 0
+    migrated = 0
+    skipped = 0
+    for item_doc in db_handler.iter_items(db):
+        value = item_doc.to_dict().get('time')
+        if not isinstance(value, str):
+            skipped += 1
+            continue
+        try:
+            timestamp = parse_legacy_time(value, tz)
+        except ValueError:
+            print(f"skipping {item_doc.reference.path}: unrecognised time {value!r}")
+            skipped += 1
+            continue
+
+        print(f"{item_doc.reference.path}: {value!r} -> {timestamp.isoformat()}")
+        migrated += 1
+        if args.dry_run:
+            continue
+        batch.update(item_doc.reference, {'time': timestamp})
+        pending += 1
+        if pending == db_handler.BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'} {migrated} items, skipped {skipped}.")
+    db_handler.close_app_if_exists(args.app_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Trains a zstd dictionary on a sample of existing .3dm models and stores it in the bucket, so 3D models can be
+uploaded with `model_compression = "zstd"`. Set the printed id as `zstd_dictionary` in the gcp secrets to use it.
+
+Run from the repository root so the streamlit secrets are found:
+    python src/scripts/train_zstd_dictionary.py path/to/models --dry-run
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zstandard
+import file_io
+from backend import gcp_handler
+
+# zstd trains on many small samples, so each model is cut into chunks of this size
+SAMPLE_SIZE = 128 * 1024
+
+
+def read_samples(models, sample_size, max_samples, rng):
+    """Cuts the models into chunks and returns a random selection of at most max_samples of them."""
+    samples = []
+    for model in models:
+        with open(model, 'rb') as f:
+            samples.extend(iter(lambda: f.read(sample_size), b''))
+    rng.shuffle(samples)
+    return samples[:max_samples]
+
+
+def compressed_size(models, level, dictionary):
+    """Returns the total size of the models compressed the way uploads compress them."""
+    size = 0
+    for model in models:
+        digests = {}
+        with open(model, 'rb') as f:
+            for _ in file_io.iter_compress(f, digests, 'zstd', level, dictionary):
+                pass
+        size += digests['size']
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='.3dm files or directories holding them')
+    parser.add_argument('--dict-size', type=int, default=112 * 1024, help='size of the trained dictionary in bytes')
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE, help='size of each training sample')
+    parser.add_argument('--max-samples', type=int, default=20000, help='maximum number of training samples')
+    parser.add_argument('--holdout', type=float, default=0.2, help='fraction of the models kept out of training')
+    parser.add_argument('--level', type=int, default=file_io.ZSTD_LEVEL, help='zstd level the dictionary is tuned for')
+    parser.add_argument('--root', default='Inventory', help='root folder of the bucket the dictionary is stored in')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sample selection')
+    parser.add_argument('--dry-run', action='store_true', help='only report the gain, do not store the dictionary')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    models = file_io.find_models(args.paths)
+    if len(models) < 2:
+        parser.error('at least two .3dm files are needed to train and evaluate a dictionary')
+    rng.shuffle(models)
+    holdout = max(1, int(len(models) * args.holdout))
+    evaluation, training = models[:holdout], models[holdout:]
+
+    samples = read_samples(training, args.sample_size, args.max_samples, rng)
+    print(f"Training a {args.dict_size // 1024}KB dictionary on {len(samples)} samples from {len(training)} models...")
+    dictionary = zstandard.train_dictionary(args.dict_size, samples, level=args.level, threads=-1)
+
+    original = sum(os.path.getsize(model) for model in evaluation)
+    plain = compressed_size(evaluation, args.level, None)
+    trained = compressed_size(evaluation, args.level, dictionary)
+    print(f"{len(evaluation)} held out models, {original / 1e6:.1f}MB: ratio {original / plain:.2f} without the "
+          f"dictionary, {original / trained:.2f} with it")
+
+    if args.dry_run:
+        return
+    blob = gcp_handler.upload_zstd_dictionary(args.root, dictionary)
+    print(f"Stored {blob.name}. Set zstd_dictionary = {dictionary.dict_id()} in the gcp secrets to use it.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import re
+import threading
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# length of the n-grams indexed for substring search
+NGRAM = 3
+
+# numeric queries: "10..20" for a range, ">=10", ">10", "<=20", "<20" for open ranges, else a single value
+RANGE_PATTERN = re.compile(r'^\s*(?P<low>.*?)\s*\.\.\s*(?P<high>.*?)\s*$')
+BOUND_PATTERN = re.compile(r'^\s*(?P<op>>=|<=|>|<)\s*(?P<value>.+?)\s*$')
+
+
+def _ngrams(text):
+    """Returns the set of n-grams of the text."""
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def _group_rows(codes, count):
+    """Groups the row positions by their code, so the rows of a code are rows[starts[code]:starts[code + 1]]."""
+    rows = np.argsort(codes, kind='stable')
+    starts = np.searchsorted(codes[rows], np.arange(count + 1))
+    return rows, starts
+
+
+def _build_text_index(column):
+    """Indexes a string column: its distinct values, the rows holding each value and an n-gram index over them."""
+    codes, uniques = pd.factorize(column)
+    values = [str(value).lower() for value in uniques]
+    rows, starts = _group_rows(codes, len(values))
+
+    value_ids = {}
+    postings = {}
+    for value_id, value in enumerate(values):
+        # distinct values differing only in case share a lowercase entry
+        value_ids.setdefault(value, []).append(value_id)
+        for gram in _ngrams(value):
+            postings.setdefault(gram, []).append(value_id)
+
+    return {
+        'kind': 'text',
+        'values': values,
+        'value_ids': value_ids,
+        'postings': {gram: np.array(ids) for gram, ids in postings.items()},
+        'rows': rows,
+        'starts': starts
+    }
+
+
+def _build_numeric_index(column):
+    """Indexes a numeric column as its values sorted, alongside the row holding each value."""
+    values = column.to_numpy(dtype=float)
+    missing = np.isnan(values)
+    present = np.flatnonzero(~missing)
+    order = present[np.argsort(values[present], kind='stable')]
+    return {
+        'kind': 'numeric',
+        'sorted': values[order],
+        'rows': order,
+        'missing': np.flatnonzero(missing)
+    }
+
+
+def _build_bool_index(column):
+    """Indexes a boolean column as the rows holding True, False or nothing."""
+    return {
+        'kind': 'bool',
+        True: np.flatnonzero(column == True),
+        False: np.flatnonzero(column == False),
+        'missing': np.flatnonzero(column.isna())
+    }
+
+
+def build_column_index(column):
+    """Builds the index of a single column, or returns None if its type is not searchable."""
+    if column.dtype == 'object':
+        return _build_text_index(column)
+    elif column.dtype in ['int64', 'float64']:
+        return _build_numeric_index(column)
+    elif column.dtype == 'bool':
+        return _build_bool_index(column)
+    return None
+
+
+def build_index(df):
+    """Creates a search index over the DataFrame, each column indexed on its first lookup."""
+    return {'frame': df, 'columns': {}, 'lock': threading.Lock()}
+
+
+def get_column_index(index, key):
+    """Returns the index of a column, building it the first time the column is searched."""
+    columns = index['columns']
+    if key not in columns:
+        with index['lock']:
+            if key not in columns and key in index['frame'].columns:
+                columns[key] = build_column_index(index['frame'][key])
+    return columns.get(key)
+
+
+@st.cache_resource(max_entries=2)
+def get_index(_df, version):
+    """Returns the search index of the inventory, built once per inventory version and shared across sessions."""
+    return build_index(_df)
+
+
+def _text_rows(column_index, value_ids):
+    """Returns the sorted row positions holding any of the distinct values."""
+    rows = column_index['rows']
+    starts = column_index['starts']
+    if len(value_ids) == 0:
+        return np.array([], dtype=np.intp)
+    return np.sort(np.concatenate([rows[starts[i]:starts[i + 1]] for i in value_ids]))
+
+
+def lookup_text(column_index, query, exact=False):
+    """Returns the rows whose value contains the query, or equals it if exact, case insensitive."""
+    query = query.lower()
+    values = column_index['values']
+    if exact:
+        return _text_rows(column_index, column_index['value_ids'].get(query, []))
+
+    grams = _ngrams(query)
+    if grams:
+        # only the values holding every n-gram of the query can contain it
+        candidates = None
+        for gram in grams:
+            ids = column_index['postings'].get(gram)
+            if ids is None:
+                return _text_rows(column_index, [])
+            candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique=True)
+    else:
+        # queries shorter than an n-gram check the distinct values only
+        candidates = range(len(values))
+    return _text_rows(column_index, [i for i in candidates if query in values[i]])
+
+
+def _parse_range(query):
+    """Parses a numeric query into (low, high, low inclusive, high inclusive). Returns None if it is not numeric."""
+    try:
+        match = RANGE_PATTERN.match(query)
+        if match:
+            low = float(match['low']) if match['low'] else -np.inf
+            high = float(match['high']) if match['high'] else np.inf
+            return low, high, True, True
+        match = BOUND_PATTERN.match(query)
+        if match:
+            value = float(match['value'])
+            return {
+                '>=': (value, np.inf, True, True),
+                '>': (value, np.inf, False, True),
+                '<=': (-np.inf, value, True, True),
+                '<': (-np.inf, value, True, False)
+            }[match['op']]
+        value = float(query)
+        return value, value, True, True
+    except ValueError:
+        return None
+
+
+def lookup_numeric(column_index, query):
+    """Returns the rows matching the numeric query plus those missing a value, or None if not numeric."""
+    bounds = _parse_range(query)
+    if bounds is None:
+        return None
+    low, high, low_inclusive, high_inclusive = bounds
+    sorted_values = column_index['sorted']
+    start = np.searchsorted(sorted_values, low, side='left' if low_inclusive else 'right')
+    end = np.searchsorted(sorted_values, high, side='right' if high_inclusive else 'left')
+    return np.sort(np.concatenate([column_index['rows'][start:end], column_index['missing']]))
+
+
+def lookup(index, key, query):
+    """Returns the sorted row positions matching the query in the column, or None if the query cannot filter it."""
+    column_index = get_column_index(index, key)
+    if column_index is None:
+        return None
+    if column_index['kind'] == 'text':
+        # a leading "=" asks for the exact value instead of a substring
+        if query.startswith('='):
+            return lookup_text(column_index, query[1:], exact=True)
+        return lookup_text(column_index, query)
+    if column_index['kind'] == 'numeric':
+        return lookup_numeric(column_index, query)
+    bool_value = query.lower() in ['true', 'yes', '1']
+    return np.sort(np.concatenate([column_index[bool_value], column_index['missing']]))
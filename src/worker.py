@@ -0,0 +1,255 @@
+"""Runs the submissions queued by the data entry form (backend/job_queue.py): encodes and uploads the assets, then
+writes the item. The app starts a worker when it queues a job and none is alive; the worker exits once the queue has
+been idle for a while. It can also be run by hand from the repository root so the streamlit secrets are found:
+    python src/worker.py --idle 0
+"""
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from firebase_admin import firestore
+from backend import db_handler, gcp_handler, job_queue
+import file_io
+
+APP_NAME = 'worker'
+# number of assets uploaded at once
+UPLOAD_WORKERS = 4
+# seconds between polls of an empty queue, and between heartbeats
+POLL_INTERVAL = 2
+HEARTBEAT_INTERVAL = 10
+# checkpoint recorded once the content-addressed assets of a job hold their references
+ACQUIRED = 'acquired'
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(file_io.STREAM_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def upload_image(bucket, root, encoded, thumbnails, folder, name, owner, metadata):
+    """Uploads the thumbnails of an image, then the image pointing at them in its metadata."""
+    urls = gcp_handler.upload_thumbnails(bucket, root, thumbnails, folder, name, owner)
+    return gcp_handler.upload_blob(bucket, root, encoded, folder, name, owner, metadata={**metadata, **urls})
+
+
+def upload_assets(db, bucket, job):
+    """Encodes and uploads the assets of the job concurrently and returns the blobs in submission order."""
+    payload = job['payload']
+    root, uid, filename, owner = payload['root'], payload['uid'], payload['filename'], job['owner']
+    content_addressed = gcp_handler.is_content_addressed()
+    files = payload['images'] + payload['model']
+    labels = [file['name'] for file in files]
+    blobs = [None] * len(files)
+
+    def destination(name, original_md5):
+        """Returns the folder and name an asset is uploaded under."""
+        if content_addressed:
+            return gcp_handler.CAS_DIR, original_md5
+        return uid, name
+
+    images = []
+    for img_count, image in enumerate(payload['images']):
+        with open(image['path'], 'rb') as f:
+            img_data = f.read()
+        img_meta = {
+            'category': 'image',
+            'original_name': image['name'],
+            'original_size': len(img_data),
+            'original_md5': hashlib.md5(img_data).hexdigest()
+        }
+        folder, name = destination(f'{filename}-{img_count:02d}', img_meta['original_md5'])
+        images.append((img_count, img_data, img_meta, folder, name))
+
+    # the original size and md5 of the model are computed while it is compressed, the content-addressed layout
+    # needs the md5 up front to look the model up
+    model = payload['model'][0]
+    model_meta = {
+        'category': '3d_model',
+        'original_name': model['name']
+    }
+    model_folder, model_name = destination(filename, file_md5(model['path']) if content_addressed else None)
+    compress, level, dictionary = gcp_handler.get_model_compression(root)
+    max_side = gcp_handler.get_image_max_side()
+    # written by the model upload as its parts are sent, reported with the job progress
+    model_progress = {'done': 0, 'total': 0}
+
+    def on_model_progress(done, total):
+        model_progress.update(done=done, total=total)
+
+    # one lookup for every asset already stored in the content-addressed layout, images are uploaded as webp
+    keys = [gcp_handler.get_blob_filename(f'{name}.webp', name) for _, _, _, _, name in images] + \
+           [gcp_handler.get_blob_filename(model['path'], model_name, compress=compress)]
+    stored = db_handler.get_assets(db, keys) if content_addressed else {}
+    for position, key in enumerate(keys):
+        if key in stored:
+            blobs[position] = bucket.blob(stored[key]['path'])
+            blobs[position].metadata = stored[key]['metadata']
+    for position, (blob_name, metadata) in job_queue.get_recorded_assets(job['id']).items():
+        if blobs[position] is None:
+            blobs[position] = bucket.blob(blob_name)
+            blobs[position].metadata = metadata
+
+    # images are decoded and encoded in the process-wide image pool, one per core
+    encoder = file_io.get_image_pool()
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploader, \
+            open(model['path'], 'rb') as model_file:
+        uploads = {}
+        if blobs[-1] is None:
+            uploads[uploader.submit(gcp_handler.upload_blob, bucket, root, model_file, model_folder, model_name,
+                                    owner, metadata=model_meta, compress=compress, level=level, dictionary=dictionary,
+                                    progress=on_model_progress)] = len(labels) - 1
+        encodes = {}
+        for img_count, img_data, img_meta, folder, name in images:
+            if blobs[img_count] is None:
+                future = encoder.submit(file_io.encode_image, img_data, labels[img_count], quality=90, format='webp',
+                                        max_side=max_side)
+                thumbnails = encoder.submit(file_io.encode_thumbnails, img_data, labels[img_count])
+                encodes[future] = (img_count, img_meta, folder, name, thumbnails)
+
+        # each image is uploaded as soon as it is encoded. Every finished upload is recorded before a failure is
+        # raised, so a retry skips it
+        failed = None
+        for done, future in enumerate(as_completed(encodes), start=1):
+            img_count, img_meta, folder, name, thumbnails = encodes[future]
+            error = future.exception() or thumbnails.exception()
+            if error is not None:
+                failed = failed or error
+                continue
+            encoded, report = future.result()
+            message = file_io.format_image_report(report)
+            print(message)
+            job_queue.set_progress(job['id'], f'Encoded {done}/{len(encodes)} images: {message}')
+            uploads[uploader.submit(upload_image, bucket, root, encoded, thumbnails.result(), folder, name, owner,
+                                    img_meta)] = img_count
+
+        pending = set(uploads)
+        while pending:
+            finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future.exception() is not None:
+                    failed = failed or future.exception()
+                    continue
+                blobs[uploads[future]] = future.result()
+                job_queue.record_asset(job['id'], uploads[future], blobs[uploads[future]])
+            message = f'Uploaded {len(uploads) - len(pending)}/{len(uploads)} assets'
+            if blobs[-1] is None and model_progress['total']:
+                message += f", 3D model {model_progress['done'] / model_progress['total']:.0%}"
+            job_queue.set_progress(job['id'], message)
+        if failed is not None:
+            raise failed
+
+    if content_addressed and job['checkpoint'] != ACQUIRED:
+        # the item holds a reference to each of its assets, new uploads create their asset documents
+        missing = db_handler.acquire_assets(db, [(key, {} if key in stored else {'path': blob.name,
+                                                                                 'metadata': blob.metadata})
+                                                 for key, blob in zip(keys, blobs)])
+        if missing:
+            # the last item referring to them was deleted since they were looked up, upload them again
+            print(f"{len(missing)} stored assets were deleted meanwhile, uploading them again")
+            return upload_assets(db, bucket, job)
+        job_queue.set_checkpoint(job['id'], ACQUIRED)
+    return blobs
+
+
+def run_submission(db, bucket, job):
+    """Uploads the assets of a submitted item, if any, and writes the item. Returns the uid of the item."""
+    payload = job['payload']
+    root, uid, filename = payload['root'], payload['uid'], payload['filename']
+    data = payload['data']
+    if not payload['model']:
+        # the assets are locked, only the fields change
+        db_handler.update_item(db, job['owner'], uid, data)
+        return {'uid': uid}
+
+    blobs = upload_assets(db, bucket, job)
+    # read the urls and hashes from the uploaded blobs instead of listing the bucket
+    thumbnail_infos = [f'thumbnail_{size}' for size in file_io.THUMBNAIL_SIZES]
+    blob_info = gcp_handler.get_blob_info(root, uid, f'{filename}*',
+                                          ['url', 'original_md5', 'md5_hash', 'size'] + thumbnail_infos, blobs=blobs)
+    data = {
+        **data,
+        'images': blob_info['image']['url'],
+        '3d_model': blob_info['3d_model']['url'],
+        'original_md5': blob_info['3d_model']['original_md5'],
+        'md5_hash': blob_info['3d_model']['md5_hash'],
+        # stored size of each model, metadata values come back from the bucket as strings
+        'model_size': [int(size) if size is not None else None for size in blob_info['3d_model']['size']],
+        # thumbnail urls in the order of the images, e.g. thumbnails_128
+        **{f'thumbnails_{size}': blob_info['image'][f'thumbnail_{size}'] for size in file_io.THUMBNAIL_SIZES},
+        # the shared content-addressed assets the item holds a reference to
+        'assets': [blob.name.split('/')[-1] for blob in blobs
+                   if blob.name.startswith(f'{root}/{gcp_handler.CAS_DIR}/')]
+    }
+    job_queue.set_progress(job['id'], 'Writing the item')
+    db_handler.set_item(db, job['owner'], uid, data, write_id=job['id'])
+    return {'uid': uid}
+
+
+HANDLERS = {
+    'submit': run_submission
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--idle', type=float, default=600,
+                        help='seconds the queue may stay empty before the worker exits, 0 to run forever')
+    args = parser.parse_args()
+
+    pid = os.getpid()
+    db = firestore.client(app=db_handler.get_init_firestore_app(APP_NAME))
+    gcp_handler.init()
+    bucket = gcp_handler.get_bucket()
+
+    # beats from a thread, so a long upload does not make the worker look dead
+    current = {'job_id': None}
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(HEARTBEAT_INTERVAL):
+            job_queue.heartbeat(pid, current['job_id'])
+
+    job_queue.heartbeat(pid)
+    threading.Thread(target=beat, daemon=True).start()
+    print(f'worker {pid} started')
+    idle_since = time.monotonic()
+    try:
+        while True:
+            job = job_queue.claim_job()
+            if job is None:
+                if args.idle and time.monotonic() - idle_since > args.idle:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            current['job_id'] = job['id']
+            print(f"running job {job['id']} ({job['kind']}, attempt {job['attempts']})")
+            try:
+                result = HANDLERS[job['kind']](db, bucket, job)
+            except Exception as e:
+                print(traceback.format_exc())
+                job_queue.fail_job(job['id'], f'{e}\n\n{traceback.format_exc()}')
+            else:
+                job_queue.finish_job(job['id'], result)
+                print(f"finished job {job['id']}")
+            current['job_id'] = None
+            idle_since = time.monotonic()
+    finally:
+        stopped.set()
+        job_queue.remove_worker(pid)
+        db_handler.close_app_if_exists(APP_NAME)
+        print(f'worker {pid} stopped')
+
+
+if __name__ == '__main__':
+    main()